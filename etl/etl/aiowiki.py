@@ -0,0 +1,410 @@
+# Uploading to a wiki from an asyncio event loop.
+#
+# wiki.WikiSession is built on mwclient, which blocks, so uploading to
+# several wikis at once (say every competition, and then GlobalView) means
+# a thread for every request in flight.  An AsyncWikiSession does the same
+# uploads as coroutines, with aiohttp, so any number of them can run in one
+# event loop.  Sessions can share one aiohttp connector, and so one pool of
+# connections, while each keeps its own cookies, which is where the wiki
+# keeps the login.
+#
+# It logs in the way mwclient does (a login token, and then action=login),
+# and talks to the same api.php, so it can be pointed at anything
+# WikiSession can, including a stand-in server for testing.
+#
+# aiohttp is only needed for this module, so it's an extra of the etl
+# package ("pip install etl[async]").  etl/checks/aiowiki runs a session
+# against a stand-in for api.php.
+
+import asyncio
+import json
+
+import aiohttp
+import mwclient
+
+from etl import multipart, scheduler, uploads, wiki
+
+
+class AsyncWikiSession:
+    """The asyncio version of wiki.WikiSession, which uploads the
+    information about a competition to the wiki at URL, as COMPETITION_NAME,
+    logged in with USERNAME and PASSWORD.
+
+    CONNECTOR, an aiohttp.TCPConnector, is the pool of connections to use,
+    to share one between sessions, or one of its own is made.  At most
+    MAX_CONCURRENCY writes are in flight at once.  Like WikiSession, the
+    writes that fail are reported after each step, and compress_uploads
+    gzips the sheet as it's uploaded.
+
+    It has to be logged in before anything else, which is done when it's
+    used as an async context manager:
+
+        async with AsyncWikiSession(...) as session:
+            await session.upload_sheet(comp)"""
+
+    def __init__(
+        self,
+        username,
+        password,
+        competition_name,
+        url,
+        connector=None,
+        max_concurrency=scheduler.DEFAULT_MAX_CONCURRENCY,
+    ):
+        self.username = username
+        self.password = password
+        self.competition_name = competition_name
+        self.api_url = url.rstrip("/") + "/api.php"
+        self.connector = connector
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.http_session = None
+        self.csrf_token = None
+        self.rights = []
+        self.failures = []
+        self.csv_only = False
+        self.compress_uploads = False
+
+    async def __aenter__(self):
+        try:
+            await self.login()
+        except BaseException:
+            await self.close()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def login(self):
+        """Opens the session and logs in, raising a mwclient.errors.LoginError
+        if the wiki turns the login down"""
+        if self.http_session is None:
+            # We need a very large timeout because uploading reindexes everything!
+            # The cookie jar takes cookies from wikis at ip addresses, like
+            # requests (and so mwclient) does, which aiohttp's doesn't by default
+            self.http_session = aiohttp.ClientSession(
+                connector=self.connector,
+                connector_owner=self.connector is None,
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                timeout=aiohttp.ClientTimeout(total=300),
+            )
+
+        result = await self.api("query", meta="tokens", type="login")
+        result = await self.api(
+            "login",
+            lgname=self.username,
+            lgpassword=self.password,
+            lgtoken=result["query"]["tokens"]["logintoken"],
+        )
+        if result["login"]["result"] != "Success":
+            raise mwclient.errors.LoginError(
+                self, result["login"]["result"], result["login"].get("reason")
+            )
+
+        result = await self.api(
+            "query", meta="tokens|userinfo", type="csrf", uiprop="rights"
+        )
+        self.csrf_token = result["query"]["tokens"]["csrftoken"]
+        self.rights = result["query"]["userinfo"].get("rights", [])
+
+    async def close(self):
+        if self.http_session is not None:
+            await self.http_session.close()
+            self.http_session = None
+
+    async def raw_call(self, data, files=None, compress=False):
+        """Posts DATA, a dict, to the api, along with FILES, a dict of field
+        name to contents, as a multipart upload, and returns the text of the
+        response.  The contents can be a binary file, which is streamed from
+        where it is now, and gzipped if COMPRESS.  429s are tried again,
+        after waiting as long as the wiki asks, and other error statuses
+        raise an aiohttp.ClientResponseError."""
+        files = files or {}
+        positions = {
+            name: contents.tell()
+            for (name, contents) in files.items()
+            if hasattr(contents, "tell")
+        }
+        for attempt in range(scheduler.MAX_RETRIES + 1):
+            # A FormData can only be sent once, so it's made for every try
+            form = aiohttp.FormData()
+            for name, value in data.items():
+                form.add_field(name, value)
+            for name, contents in files.items():
+                if name in positions:
+                    contents = file_chunks(contents, positions[name])
+                form.add_field(name, contents, filename=name)
+
+            async with self.http_session.post(
+                self.api_url, data=form, compress="gzip" if compress else None
+            ) as response:
+                if response.status == 429 and attempt < scheduler.MAX_RETRIES:
+                    await asyncio.sleep(scheduler.retry_after(response, attempt))
+                    continue
+                response.raise_for_status()
+                return await response.text()
+
+    async def api(self, action, **params):
+        """Calls the api ACTION with PARAMS, and returns the result, raising a
+        mwclient.errors.APIError if it's an error, as mwclient.Site.api does"""
+        params["action"] = action
+        params["format"] = "json"
+        result = json.loads(await self.raw_call(params))
+        if "error" in result:
+            raise mwclient.errors.APIError(
+                result["error"].get("code"), result["error"].get("info"), params
+            )
+        return result
+
+    async def run_write(self, description, function, *args):
+        """Awaits FUNCTION with ARGS once there's room for another write,
+        and returns the result, or None if it failed, in which case it's
+        added to failures"""
+        async with self.semaphore:
+            try:
+                return await function(*args)
+            except Exception as e:
+                self.failures.append((description, e))
+                return None
+
+    async def run_writes(self, writes):
+        """Runs WRITES, an iterable of (description, function, args) tuples
+        (see run_write), and returns their results, and then reports the
+        ones that failed"""
+        results = await asyncio.gather(
+            *(
+                self.run_write(description, function, *args)
+                for (description, function, args) in writes
+            )
+        )
+        self.report()
+        return results
+
+    def report(self):
+        """Prints the writes that failed since the last report, if any"""
+        scheduler.print_failures(self.failures)
+        self.failures = []
+
+    async def upload_sheet(self, comp, extra_pages=None):
+        """Uploads the sheet, the tocs, and creates the pages for
+        a Competition COMP, along with EXTRA_PAGES (see create_pages)"""
+        await self.raw_call(
+            {
+                "action": "torquedataconnectuploadsheet",
+                "format": "json",
+                "object_name": "proposal",
+                "sheet_name": self.competition_name,
+                "key_column": comp.key_column_name,
+            },
+            {"data_file": comp.csv_file()},
+            self.compress_uploads,
+        )
+
+        await self.run_writes(
+            ("Uploading toc " + toc.name, self.upload_toc, (toc,)) for toc in comp.tocs
+        )
+
+        if not self.csv_only:
+            await self.create_pages(comp, extra_pages)
+
+    async def upload_attachments(self, attachments, upload_manifest=None):
+        """Uploads all the ATTACHMENTS, which is a list of
+        competition.Attachment, streaming each one from where it is, and
+        skipping and recording them with UPLOAD_MANIFEST, an
+        uploads.UploadManifest, if it's passed in (see
+        wiki.WikiSession.upload_attachments)"""
+
+        if self.csv_only:
+            return
+
+        if upload_manifest is not None:
+            attachments = [
+                attachment
+                for attachment in attachments
+                if not upload_manifest.is_uploaded(self.competition_name, attachment)
+            ]
+        progress = uploads.UploadProgress(
+            len(attachments), sum(attachment.size() for attachment in attachments)
+        )
+
+        # Each one is recorded as soon as it's uploaded, so that a run
+        # that's interrupted picks up where it left off
+        async def upload_and_record(attachment):
+            attachment, sha256, size = await self.upload_attachment(attachment)
+            if upload_manifest is not None:
+                upload_manifest.record_upload(
+                    self.competition_name, attachment, sha256, size
+                )
+            progress.record(size)
+
+        await self.run_writes(
+            ("Uploading " + attachment.file, upload_and_record, (attachment,))
+            for attachment in attachments
+        )
+        progress.finish()
+
+        if upload_manifest is not None:
+            upload_manifest.report()
+
+    async def upload_attachment(self, attachment):
+        """Uploads ATTACHMENT, a competition.Attachment, streamed from where
+        it is, and returns it along with the sha256 and size of what was
+        uploaded"""
+        with attachment.open() as attachment_stream:
+            reader = uploads.HashingReader(attachment_stream)
+            await self.raw_call(
+                {
+                    "action": "torquedataconnectuploadattachment",
+                    "format": "json",
+                    "sheet_name": self.competition_name,
+                    "object_id": attachment.key,
+                    "permissions_column": attachment.column_name,
+                    "attachment_name": attachment.file,
+                },
+                {"attachment": reader},
+            )
+        return (attachment, reader.sha256(), reader.size)
+
+    async def upload_toc(self, toc):
+        """Upload a Toc represented by TOC, which will also create the page
+        for the Toc if it doesn't already exist on the wiki"""
+        await self.raw_call(
+            {
+                "action": "torquedataconnectuploadtoc",
+                "format": "json",
+                "sheet_name": self.competition_name,
+                "toc_name": toc.name,
+            },
+            {"template": toc.template_file(), "json": json.dumps(toc.grouped_data())},
+        )
+
+        queried = await self.query_titles([toc.name])
+        if toc.name in queried and not queried[toc.name][1]:
+            await self.create_missing_page(
+                toc.name, wiki.toc_page_body(self.competition_name, toc)
+            )
+
+    async def create_pages(self, comp, extra_pages=None):
+        """Creates the pages for the proposals in the Competition COMP, and
+        EXTRA_PAGES, that don't already exist, and reports the orphaned ones
+        (see wiki.WikiSession.create_pages)"""
+        pages = wiki.proposal_pages(comp, self.competition_name, extra_pages)
+        normalized_titles = await self.create_missing_pages(pages)
+        if wiki.reports_orphaned_pages(comp):
+            await self.report_orphaned_pages(normalized_titles, comp.previous_keys)
+
+    async def create_page(self, page_title, body, create_if_exists=False):
+        if not page_title:
+            return
+
+        write = (
+            "Saving " + page_title,
+            self.save_page,
+            (page_title, body, create_if_exists),
+        )
+        await self.run_writes([write])
+
+    async def save_page(self, page_title, body, create_if_exists):
+        """Saves the page PAGE_TITLE with BODY, if it doesn't exist or
+        CREATE_IF_EXISTS"""
+        if create_if_exists:
+            await self.edit(page_title, body)
+        else:
+            await self.create_missing_page(page_title, body)
+
+    async def edit(self, page_title, body, **params):
+        """Saves BODY as the page PAGE_TITLE, with the edit PARAMS"""
+        await self.api(
+            "edit",
+            title=page_title,
+            text=body,
+            token=self.csrf_token,
+            bot="1",
+            **params
+        )
+
+    async def query_titles(self, titles):
+        """Returns what wiki.WikiSession.query_titles does, with the batches
+        asked about at once"""
+        batch_size = wiki.TITLES_PER_QUERY
+        if "apihighlimits" in self.rights:
+            batch_size = 500
+
+        async def query_batch(batch):
+            result = await self.api("query", titles="|".join(batch))
+            return wiki.parse_titles_query(batch, result)
+
+        queried = {}
+        for batch_queried in await asyncio.gather(
+            *(
+                query_batch(titles[start : start + batch_size])
+                for start in range(0, len(titles), batch_size)
+            )
+        ):
+            queried.update(batch_queried)
+        return queried
+
+    async def create_missing_pages(self, pages):
+        """Saves the PAGES, a dict of title to body, that don't exist on the
+        wiki, and returns the set of all their titles as the wiki normalizes
+        them"""
+        titles = [title for title in pages if title]
+        queried = await self.query_titles(titles)
+
+        for title in titles:
+            if title not in queried:
+                self.failures.append(("Saving " + title, "not a valid title"))
+
+        results = await self.run_writes(
+            ("Saving " + title, self.create_missing_page, (title, pages[title]))
+            for title in titles
+            if title in queried and not queried[title][1]
+        )
+        created = results.count(True)
+
+        print(
+            "%d pages created, %d already existed" % (created, len(queried) - created)
+        )
+        return {normalized_title for (normalized_title, exists) in queried.values()}
+
+    async def create_missing_page(self, page_title, body):
+        """Creates the page PAGE_TITLE with BODY, and returns whether it did,
+        which it doesn't if the page was made since it was asked about"""
+        try:
+            await self.edit(page_title, body, createonly="1")
+        except mwclient.errors.APIError as e:
+            if e.code != "articleexists":
+                raise
+            return False
+        return True
+
+    async def report_orphaned_pages(self, titles, previous_keys):
+        """Prints the pages on the wiki that were for one of PREVIOUS_KEYS but
+        aren't in TITLES (see wiki.WikiSession.report_orphaned_pages)"""
+        orphaned_titles = []
+        params = {"list": "allpages", "aplimit": "max"}
+        while True:
+            result = await self.api("query", **params)
+            orphaned_titles.extend(
+                page["title"]
+                for page in result["query"]["allpages"]
+                if wiki.is_orphaned(page["title"], titles, previous_keys)
+            )
+            if "continue" not in result:
+                break
+            params.update(result["continue"])
+        wiki.print_orphaned_pages(orphaned_titles)
+
+
+async def file_chunks(f, position):
+    """Reads the binary file F from POSITION, a chunk at a time, which
+    aiohttp streams without closing F after, as it does with files.  The
+    reads are done in the event loop's executor, so that a large attachment
+    doesn't hold up the uploads of other sessions in the same loop."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, f.seek, position)
+    while True:
+        chunk = await loop.run_in_executor(None, f.read, multipart.CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,167 @@
+# A persistent cache for the results of cleaning up cells.
+#
+# Between runs of the same competition almost every cell is unchanged,
+# but without a cache every run cleans every cell again.  A CellCache
+# keeps the cleaned cells in a sqlite database, keyed on a hash of the
+# raw cell and the version of the cleaning, so that a processor only has
+# to do the work for cells it hasn't seen before.
+#
+# This is only for processors whose results depend on nothing but the
+# text of the cell, like FixCellProcessor.
+
+import hashlib
+import sqlite3
+
+
+class CellCache:
+    """A cache of cleaned up cells, stored in the sqlite database at
+    LOCATION, which is created if it doesn't exist.
+
+    VERSION is the version of the cleaning, for instance
+    utils.fix_cell_version.  It's part of every key, and if the database
+    was last used with a different VERSION, everything in it is thrown out
+    when it's opened.
+
+    Lookups go to the database, but new entries are held in memory until
+    save is called.  Saving also evicts the least recently used entries
+    when there are more than MAX_ENTRIES, or the cleaned up cells come to
+    more than MAX_SIZE bytes, where recently used means in the most recent
+    runs that saved."""
+
+    def __init__(self, location, version, max_entries=1000000, max_size=2**30):
+        self.location = location
+        self.version = version
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.read_only = False
+        self.pending = {}
+        self.used = set()
+        self.connection = None
+        self.generation = None
+
+    def __getstate__(self):
+        # The connection can't be pickled, so the copy that goes to or
+        # comes back from a worker process reconnects when needed.
+        state = self.__dict__.copy()
+        state["connection"] = None
+        return state
+
+    def connect(self):
+        """Opens the database if it isn't already, clearing it out if it's
+        from a different version, and returns the connection"""
+        if self.connection is not None:
+            return self.connection
+
+        if self.read_only:
+            self.connection = sqlite3.connect(
+                "file:%s?mode=ro" % self.location, uri=True
+            )
+            return self.connection
+
+        self.connection = sqlite3.connect(self.location)
+        # Databases from before the size of each value was kept are started
+        # over
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(cells)")
+        ]
+        if columns and "size" not in columns:
+            self.connection.execute("DROP TABLE cells")
+
+        # There's no index on used, because updating it for every cell
+        # that gets used costs more than the sort when evicting does.
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS cells "
+            "(key BLOB PRIMARY KEY, value TEXT, size INTEGER, used INTEGER) "
+            "WITHOUT ROWID"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)"
+        )
+        row = self.connection.execute(
+            "SELECT value FROM metadata WHERE name = 'version'"
+        ).fetchone()
+        if row is None or row[0] != self.version:
+            self.connection.execute("DELETE FROM cells")
+            self.connection.execute(
+                "INSERT OR REPLACE INTO metadata VALUES ('version', ?)",
+                (self.version,),
+            )
+            self.connection.commit()
+
+        (last_generation,) = self.connection.execute(
+            "SELECT MAX(used) FROM cells"
+        ).fetchone()
+        self.generation = (last_generation or 0) + 1
+        return self.connection
+
+    def key(self, text):
+        """Returns the key for the raw cell TEXT"""
+        return hashlib.sha256((self.version + "\0" + text).encode("utf-8")).digest()
+
+    def get(self, text):
+        """Returns the cleaned up cell for the raw cell TEXT, or None if
+        it isn't in the cache"""
+        key = self.key(text)
+        if key in self.pending:
+            return self.pending[key]
+
+        row = (
+            self.connect()
+            .execute("SELECT value FROM cells WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        self.used.add(key)
+        return row[0]
+
+    def put(self, text, value):
+        """Remembers VALUE as the cleaned up cell for the raw cell TEXT"""
+        self.pending[self.key(text)] = value
+
+    def worker_copy(self):
+        """Returns an empty copy of this cache for a worker process, see
+        CellProcessor.worker_copy.  The copy only reads from the database,
+        and what it adds comes back through merge."""
+        # Connect here so that a version change is dealt with once, and
+        # not by every worker at the same time.
+        self.connect()
+        copy = CellCache(self.location, self.version, self.max_entries, self.max_size)
+        copy.read_only = True
+        return copy
+
+    def merge(self, other):
+        """Adds the entries and uses from OTHER, a worker_copy of this cache"""
+        self.pending.update(other.pending)
+        self.used.update(other.used)
+
+    def save(self):
+        """Writes the new entries to the database, marks the ones that were
+        used, and evicts the least recently used ones over MAX_ENTRIES or
+        MAX_SIZE"""
+        connection = self.connect()
+        connection.executemany(
+            "INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?)",
+            [
+                (key, value, len(value.encode("utf-8")), self.generation)
+                for key, value in self.pending.items()
+            ],
+        )
+        connection.executemany(
+            "UPDATE cells SET used = ? WHERE key = ?",
+            [(self.generation, key) for key in self.used],
+        )
+        # The sizes are kept in their own column so that adding them up
+        # doesn't read the values
+        connection.execute(
+            "DELETE FROM cells WHERE key IN "
+            "(SELECT key FROM "
+            "(SELECT key, ROW_NUMBER() OVER recent AS entries, "
+            "SUM(size) OVER recent AS total FROM cells "
+            "WINDOW recent AS (ORDER BY used DESC ROWS UNBOUNDED PRECEDING)) "
+            "WHERE entries > ? OR total > ?)",
+            (self.max_entries, self.max_size),
+        )
+        connection.commit()
+        self.pending = {}
+        self.used = set()
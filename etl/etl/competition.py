@@ -1,11 +1,18 @@
-from etl import utils
+from etl import files, incremental, join, scan, utils
 import csv
+import io
 import json
 import os
+import pickle
 import re
-from functools import total_ordering
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
+# How big the csv from Competition.csv_file gets before it's moved out of
+# memory into a temporary file
+CSV_SPOOL_SIZE = 32 * 1024 * 1024
+
 
 class Competition:
     """A Competition, encapsulating a set of Proposal objects"""
@@ -17,6 +24,9 @@ class Competition:
         key_column_name,
         pare=None,
         type_row_included=False,
+        storage=None,
+        included_columns=None,
+        row_filter=None,
     ):
         """Initializes the competition from the source spreadsheet in
         PROPOSALS_LOCATION (a file location).  Loads up the CSV and processes
@@ -29,7 +39,21 @@ class Competition:
         column types.  This is useful when the incoming spreadsheet was previously
         generated for torque.
 
-        PARE, when passed in, restricts the number of items as defined by utils.parse_pare"""
+        PARE, when passed in, restricts the number of items as defined by utils.parse_pare.
+        It's kept, as a utils.Pare, in pare, for the loaders of side sheets to
+        skip the rows for proposals that aren't included, and is None otherwise.
+
+        STORAGE, when passed in, is one of the engines in etl.storage (for
+        instance storage.ColumnarStorage()) that will hold the cells of the
+        proposals, rather than each Proposal holding its own dict.
+
+        INCLUDED_COLUMNS and ROW_FILTER restrict what gets loaded while the
+        spreadsheet is read, so that data that would be thrown away later
+        is never held.  INCLUDED_COLUMNS, when passed in, is a list of the
+        column names to keep (the key column is always kept).  ROW_FILTER,
+        when passed in, is a ProposalFilter that's checked against each row,
+        with the same meaning as filter_proposals.  It's checked against the
+        whole row, so it can use columns not in INCLUDED_COLUMNS."""
         try:
             proposals_reader = csv.reader(
                 open(proposals_location, encoding="utf-8"), delimiter=",", quotechar='"'
@@ -48,10 +72,22 @@ class Competition:
             col.strip().replace("\ufeff", "") for col in next(proposals_reader)
         ]
         self.key_column_name = key_column_name
+        self.storage = storage
+        # The columns whose cells are worked out when they're read (see
+        # InformationAdder.virtual_columns), which the proposals share
+        self.virtual_columns = {} if storage is None else storage.virtual_columns
         self.column_types = {}
         self.proposals = {}
         self.sorted_proposal_keys = []
         self.tocs = []
+        self.incremental = None
+        self.csv_spool = None
+        # The keys of the proposals that the last run had, if they're known
+        # (see tdc.ProcessedSpreadsheet), for finding the wiki pages of the
+        # ones that are gone.  They can only be found when this run has all
+        # of the proposals, so filtered is set when any are filtered out.
+        self.previous_keys = None
+        self.filtered = row_filter is not None
 
         if type_row_included:
             type_row = next(proposals_reader)
@@ -60,44 +96,256 @@ class Competition:
 
         row_num = 0
         key_column_idx = self.columns.index(key_column_name)
-        pare_factor, keys_to_include = utils.parse_pare(pare)
+        self.pare = None
+        if pare is not None:
+            self.pare = utils.Pare(pare)
+
+        source_columns = self.columns
+        included_column_idxs = None
+        if included_columns is not None:
+            included_columns = set(included_columns)
+            included_columns.add(key_column_name)
+            included_column_idxs = [
+                idx for idx, col in enumerate(source_columns) if col in included_columns
+            ]
+            self.columns = [source_columns[idx] for idx in included_column_idxs]
+            self.column_types = {
+                col: col_type
+                for (col, col_type) in self.column_types.items()
+                if col in included_columns
+            }
+
         for row in proposals_reader:
             row_num = row_num + 1
-            if pare_factor is not None and (row_num % pare_factor) != 0:
+            if self.pare is not None and not self.pare.includes_row(
+                row_num, row[key_column_idx]
+            ):
                 continue
 
-            if (
-                keys_to_include is not None
-                and row[key_column_idx] not in keys_to_include
+            if row_filter is not None and row_filter.filter_proposal(
+                Proposal(source_columns, row, key_column_name)
             ):
                 continue
 
-            proposal = Proposal(self.columns, row, key_column_name)
+            if included_column_idxs is not None:
+                # Short rows are short at the end, so the remaining cells
+                # still line up with self.columns
+                row = [row[idx] for idx in included_column_idxs if idx < len(row)]
+
+            if self.storage is not None:
+                proposal = self.storage.create_proposal(
+                    self.columns, row, key_column_name
+                )
+            else:
+                proposal = Proposal(
+                    self.columns, row, key_column_name, self.virtual_columns
+                )
             key = proposal.key()
             self.sorted_proposal_keys.append(key)
             self.proposals[key] = proposal
 
-    def process_all_cells_special(self, processor):
+        if self.pare is not None:
+            self.pare.narrow(self.sorted_proposal_keys)
+
+    def enable_incremental(self, config_dir, version):
+        """Reuses what the last run computed for proposals whose input hasn't
+        changed, from the state in CONFIG_DIR (the TDC config dir) that
+        tdc.ProcessedSpreadsheet writes.  VERSION is the version of the
+        pipeline, usually from incremental.pipeline_version.
+
+        Has to be called before any cells are added or processed.  Changes
+        made to proposals other than through this Competition aren't seen,
+        so steps that depend on them need to be run every time."""
+        self.incremental = incremental.IncrementalState(config_dir, version)
+        for key, proposal in self.proposals.items():
+            self.incremental.add_proposal(
+                key, self.columns, proposal.to_csv(self.columns)
+            )
+
+    def start_step(self, description, column_names, source):
+        """Starts a step of the pipeline, described by DESCRIPTION, that
+        sets COLUMN_NAMES, and returns the proposals that it needs to be run
+        on, which is the ones that reuse_cells doesn't give cells to.
+        SOURCE is the adder or processor."""
+        return [
+            proposal
+            for key, proposal in self.proposals.items()
+            if not self.reuse_cells(key, proposal, description, column_names, source)
+        ]
+
+    def finish_step(self, description, column_names, proposals, source):
+        """Records what the step described by DESCRIPTION, that was run on
+        PROPOSALS, set COLUMN_NAMES to, when incremental.  SOURCE is the
+        adder or processor, whose reports are put back in proposal order,
+        as the ones from the last run were given to it first."""
+        for proposal in proposals:
+            self.record_cells(
+                proposal.key(), proposal, description, column_names, source
+            )
+        if self.incremental is not None:
+            for key in self.proposals:
+                source.keep_proposal_report(key, source.proposal_report(key))
+
+    def reuse_cells(self, key, proposal, description, column_names, source):
+        """When incremental, and the step described by DESCRIPTION has the
+        same hash for PROPOSAL (with KEY) as the last run (see
+        incremental.IncrementalState), sets COLUMN_NAMES in PROPOSAL to last
+        run's cells, and gives SOURCE, the adder or processor, last run's
+        report for PROPOSAL.  Returns whether it did."""
+        if self.incremental is None:
+            return False
+
+        previous = self.incremental.previous_cells(
+            key, description, source.fingerprint(proposal)
+        )
+        if previous is None:
+            return False
+
+        cells, report = previous
+        for column_name, cell in zip(column_names, cells):
+            proposal.add_cell(column_name, cell)
+        source.keep_proposal_report(key, report)
+        return True
+
+    def record_cells(self, key, proposal, description, column_names, source):
+        """Records what the step described by DESCRIPTION set COLUMN_NAMES to
+        in PROPOSAL (with KEY), along with the report of SOURCE, the adder or
+        processor, for it, when incremental"""
+        if self.incremental is not None:
+            self.incremental.record_cells(
+                key,
+                description,
+                proposal.to_csv(column_names),
+                source.proposal_report(key),
+            )
+
+    def process_all_cells_special(self, processor, workers=None):
         """For all cells in the competition, apply CellProcessor PROCESSOR
-        to them"""
-        for column_name in self.columns:
-            self.process_cells_special(column_name, processor)
+        to them.  WORKERS is as in process_cells_special."""
+        self.discard_csv()
+        column_names = list(self.columns)
+        stored_virtual_columns = self.materialize_virtual_columns(column_names)
+        for column_name in column_names:
+            if processor.column_type() is not None:
+                self.column_types[column_name] = processor.column_type()
+
+        description = processor_step_description(processor, column_names)
+        proposals = self.start_step(description, column_names, processor)
+        if self.can_process_in_pool(processor, workers, proposals):
+            self.process_cells_in_pool(column_names, processor, workers, proposals)
+        else:
+            for column_name in column_names:
+                for proposal in proposals:
+                    proposal.process_cell_special(column_name, processor)
+        self.finish_step(description, column_names, proposals, processor)
+        self.restore_virtual_columns(stored_virtual_columns)
 
-    def process_cells_special(self, column_name, processor):
+    def process_cells_special(self, column_name, processor, workers=None):
         """For cells in the competition at COLUMN_NAME,
         apply the PROCESSOR to them.  PROCESSOR is an object
-        of the CellProcessor type."""
+        of the CellProcessor type.
+
+        WORKERS, when more than 1, runs the PROCESSOR in a pool of that many
+        processes, with the proposals split up between them.  The PROCESSOR
+        has to be picklable for that, and if it isn't, the cells are
+        processed here like normal."""
+        self.discard_csv()
+        stored_virtual_columns = self.materialize_virtual_columns([column_name])
         if processor.column_type() is not None:
             self.column_types[column_name] = processor.column_type()
 
-        for proposal in self.proposals.values():
-            proposal.process_cell_special(column_name, processor)
+        description = processor_step_description(processor, [column_name])
+        proposals = self.start_step(description, [column_name], processor)
+        if self.can_process_in_pool(processor, workers, proposals):
+            self.process_cells_in_pool([column_name], processor, workers, proposals)
+        else:
+            for proposal in proposals:
+                proposal.process_cell_special(column_name, processor)
+        self.finish_step(description, [column_name], proposals, processor)
+        self.restore_virtual_columns(stored_virtual_columns)
+
+    def can_process_in_pool(self, processor, workers, proposals):
+        """Returns whether PROCESSOR can be run over PROPOSALS in a pool of
+        WORKERS processes"""
+        if workers is None or workers < 2 or len(proposals) < 2:
+            return False
+
+        try:
+            pickle.dumps(processor.worker_copy())
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return False
+
+        return True
+
+    def process_cells_in_pool(self, column_names, processor, workers, proposals):
+        """Runs PROCESSOR over COLUMN_NAMES for PROPOSALS, split up between a
+        pool of WORKERS processes.  Each process gets a copy of the
+        PROCESSOR (see CellProcessor.worker_copy), and those copies are
+        merged back in to PROCESSOR in proposal order, so the result is the
+        same as processing the cells here."""
+        # More chunks than workers, so that one slow chunk doesn't hold
+        # up the pool
+        chunk_size = -(-len(proposals) // (workers * 4))
+        chunks = [
+            proposals[idx : idx + chunk_size]
+            for idx in range(0, len(proposals), chunk_size)
+        ]
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    process_proposal_cells,
+                    processor.worker_copy(),
+                    column_names,
+                    self.key_column_name,
+                    self.columns,
+                    [proposal.to_csv(self.columns) for proposal in chunk],
+                )
+                for chunk in chunks
+            ]
+            for chunk, future in zip(chunks, futures):
+                processed_rows, worker_processor = future.result()
+                for proposal, processed_row in zip(chunk, processed_rows):
+                    for column_name, cell in zip(column_names, processed_row):
+                        proposal.add_cell(column_name, cell)
+                processor.merge(worker_processor)
 
     def add_supplemental_information(self, adder):
         """Adds additional columns to the competition via ADDER.  ADDER
         must be of the InformationAdder type.  This will add the
-        headers, the column types, and the data."""
-        for column_name in adder.column_names():
+        headers, the column types, and the data.
+
+        The cells of the columns that ADDER has as virtual (see
+        InformationAdder.virtual_columns) aren't added, but worked out when
+        they're read."""
+        self.discard_csv()
+        column_names = adder.column_names()
+        virtual_columns = self.virtual_columns_for(adder)
+        stored_column_names = [
+            column_name
+            for column_name in column_names
+            if column_name not in virtual_columns
+        ]
+        stored_virtual_columns = self.materialize_virtual_columns(
+            column_names, virtual_columns
+        )
+
+        description = adder_step_description(adder, column_names)
+        proposals = self.start_step(description, stored_column_names, adder)
+        self.add_columns(adder, column_names, virtual_columns)
+        for proposal in proposals:
+            cells = adder.cells(proposal, stored_column_names)
+            for column_name in stored_column_names:
+                proposal.add_cell(column_name, cells[column_name])
+        self.finish_step(description, stored_column_names, proposals, adder)
+        self.restore_virtual_columns(stored_virtual_columns)
+
+    def add_columns(self, adder, column_names, virtual_columns):
+        """Adds COLUMN_NAMES, from ADDER, to the columns of the competition,
+        along with their types.  The ones in VIRTUAL_COLUMNS (from
+        virtual_columns_for) become virtual columns, and the cells for the
+        rest are up to the caller."""
+        for column_name in column_names:
             if adder.column_type(column_name) is not None:
                 self.column_types[column_name] = adder.column_type(column_name)
 
@@ -106,14 +354,76 @@ class Competition:
             # together.
             if column_name not in self.columns:
                 self.columns.append(column_name)
+            elif column_name in virtual_columns:
+                self.drop_stored_cells(column_name)
+
+            if column_name in virtual_columns:
+                self.virtual_columns[column_name] = virtual_columns[column_name]
+
+    def virtual_columns_for(self, adder):
+        """Returns a dict of the VirtualColumns for the columns that ADDER
+        has as virtual, by column name"""
+        return {
+            column_name: VirtualColumn(
+                adder, column_name, input_columns, self.key_column_name
+            )
+            for (column_name, input_columns) in adder.virtual_columns().items()
+        }
 
-            for proposal in self.proposals.values():
-                proposal.add_cell(column_name, adder.cell(proposal, column_name))
+    def materialize_virtual_columns(self, column_names, replaced_column_names=()):
+        """Stores the cells of the virtual columns that would change along
+        with COLUMN_NAMES, because they're one of COLUMN_NAMES or are worked
+        out from one of them, so that they keep the cells they have now.
+        Virtual columns in REPLACED_COLUMN_NAMES, which are about to be
+        replaced by new virtual columns, are dropped instead.  Returns the
+        VirtualColumns that were stored, for restore_virtual_columns."""
+        for column_name in replaced_column_names:
+            self.virtual_columns.pop(column_name, None)
+
+        column_names = set(column_names)
+        stored_virtual_columns = []
+        for virtual_column in list(self.virtual_columns.values()):
+            if not virtual_column.affected_by(column_names):
+                continue
+
+            proposals = list(self.proposals.values())
+            cells = [virtual_column.cell(proposal) for proposal in proposals]
+            del self.virtual_columns[virtual_column.column_name]
+            for proposal, cell in zip(proposals, cells):
+                proposal.add_cell(virtual_column.column_name, cell)
+            stored_virtual_columns.append(virtual_column)
+        return stored_virtual_columns
+
+    def restore_virtual_columns(self, virtual_columns):
+        """Makes VIRTUAL_COLUMNS, which materialize_virtual_columns stored
+        before a step, virtual again if all of their cells are still what
+        they'd be worked out as now, so that they aren't kept stored after
+        a step that didn't change them (like FixCellProcessor with the
+        columns of a StaticColumnAdder)."""
+        proposals = list(self.proposals.values())
+        for virtual_column in virtual_columns:
+            column_name = virtual_column.column_name
+            if all(
+                proposal.cell(column_name) == virtual_column.cell(proposal)
+                for proposal in proposals
+            ):
+                self.drop_stored_cells(column_name)
+                self.virtual_columns[column_name] = virtual_column
+
+    def drop_stored_cells(self, column_name):
+        """Drops the cells stored for COLUMN_NAME, which is becoming a virtual
+        column, as a column is never both stored and virtual"""
+        if self.storage is not None:
+            self.storage.drop_column(column_name)
+            return
+        for proposal in self.proposals.values():
+            proposal.data.pop(column_name, None)
 
     def sort(self, column_name, is_integer=False):
         """Sorts the competition by the data in COLUMN_NAME.  IS_INTEGER
         declares whether that cell should be converted to an int for
         sorting."""
+        self.discard_csv()
         if is_integer:
             sorted_proposals = sorted(
                 self.proposals.values(),
@@ -130,12 +440,16 @@ class Competition:
     def filter_proposals(self, proposal_filter):
         """Removes proposals according to PROPOSAL_FILTER, which needs
         to be an object of the instance ProposalFilter."""
+        self.discard_csv()
+        self.filtered = True
         self.sorted_proposal_keys = [
             k
             for k in self.sorted_proposal_keys
             if not proposal_filter.filter_proposal(self.proposals[k])
         ]
         self.proposals = {k: self.proposals[k] for k in self.sorted_proposal_keys}
+        if self.storage is not None:
+            self.storage.compact(self.proposals.values())
 
     def ordered_proposals(self):
         """Returns an array of Proposals ordered by the current sort"""
@@ -161,6 +475,34 @@ class Competition:
 
         return output
 
+    def csv_file(self):
+        """Returns a binary file, positioned at the start, with the csv from
+        to_csv in it, encoded as utf-8.  It's only written the first time
+        it's asked for, and the same file is returned after that, so that
+        the csv written to the TDC config dir and the one uploaded to the
+        wiki are serialized once.  The methods that change the proposals or
+        columns drop it (see discard_csv), so it's written again if it's
+        asked for after that.
+
+        The file is kept in memory while it's smaller than CSV_SPOOL_SIZE,
+        and in a temporary file after that."""
+        if self.csv_spool is None:
+            spool = tempfile.SpooledTemporaryFile(CSV_SPOOL_SIZE)
+            output = io.TextIOWrapper(spool, encoding="utf-8", newline="")
+            self.to_csv(output)
+            output.flush()
+            output.detach()
+            self.csv_spool = spool
+
+        self.csv_spool.seek(0)
+        return self.csv_spool
+
+    def discard_csv(self):
+        """Drops the file from csv_file, as the competition is changing"""
+        if self.csv_spool is not None:
+            self.csv_spool.close()
+            self.csv_spool = None
+
     def add_toc(self, toc):
         """Adds a toc.Toc to this competition."""
         self.tocs.append(toc)
@@ -171,20 +513,375 @@ class Competition:
         for toc in self.tocs:
             toc.process_competition(self)
 
+    def pipeline(self):
+        """Returns a new Pipeline for this competition, for running a
+        sequence of steps with one pass over the proposals"""
+        return Pipeline(self)
+
+
+def process_proposal_cells(processor, column_names, key_column_name, columns, rows):
+    """Run in a worker process by Competition.process_cells_in_pool.  Builds
+    Proposals out of ROWS (ordered by COLUMNS), runs the PROCESSOR over
+    COLUMN_NAMES for each of them, and returns a tuple of the processed
+    cells (per row, ordered by COLUMN_NAMES) and the PROCESSOR, so that its
+    state can be merged back in the parent process."""
+    processed_rows = []
+    for row in rows:
+        proposal = Proposal(columns, row, key_column_name)
+        for column_name in column_names:
+            proposal.process_cell_special(column_name, processor)
+        processed_rows.append([proposal.cell(name) for name in column_names])
+    return (processed_rows, processor)
+
+
+def adder_step_description(adder, column_names):
+    """Returns the description of the step that adds COLUMN_NAMES with
+    ADDER, which identifies the step in incremental runs"""
+    return "add %s %r" % (type(adder).__name__, column_names)
+
+
+def processor_step_description(processor, column_names):
+    """Returns the description of the step that runs PROCESSOR over
+    COLUMN_NAMES, which identifies the step in incremental runs"""
+    return "process %s %r" % (type(processor).__name__, column_names)
+
+
+class Pipeline:
+    """A sequence of steps to run on COMPETITION, recorded with the same
+    methods as Competition has for them (add_supplemental_information,
+    process_cells_special, process_all_cells_special, filter_proposals and
+    sort), and then run all together by run.
+
+    Rather than going through every proposal once per step, and once per
+    column for adders, run goes through the proposals once and runs every
+    step on a proposal before moving on to the next one.  That gives the
+    same result as running the steps one after the other, because steps
+    only look at the proposal they're working on, and a proposal still
+    goes through the steps in order, so columns added or processed by one
+    step are ready for the steps after it.  A filtered out proposal skips
+    the rest of the steps.
+
+    Steps that can't be run that way are barriers: the steps before a
+    barrier are run, then the barrier on its own, then the steps after it.
+    Those are adders and processors whose needs_all_proposals is true, and
+    processors with WORKERS that can be processed in a pool.  barriers
+    returns which steps they are, and why.
+
+    Adders and processors are used as they are when they're recorded, so
+    ones that are built from the competition's proposals (like
+    BasicAttachments from sorted_proposal_keys) have to be built after the
+    pipeline with the steps they depend on is run."""
+
+    def __init__(self, competition):
+        self.competition = competition
+        self.columns = list(competition.columns)
+        self.steps = []
+
+    def add_supplemental_information(self, adder):
+        """Adds a step that runs Competition.add_supplemental_information
+        with ADDER"""
+        step = AdderStep(self.competition, adder)
+        for column_name in step.column_names:
+            if column_name not in self.columns:
+                self.columns.append(column_name)
+        self.steps.append(step)
+
+    def process_cells_special(self, column_name, processor, workers=None):
+        """Adds a step that runs Competition.process_cells_special with
+        COLUMN_NAME, PROCESSOR and WORKERS"""
+        self.steps.append(
+            ProcessorStep(self.competition, [column_name], processor, workers)
+        )
+
+    def process_all_cells_special(self, processor, workers=None):
+        """Adds a step that runs Competition.process_all_cells_special with
+        PROCESSOR and WORKERS, over the columns the competition will have by
+        then"""
+        self.steps.append(
+            ProcessorStep(
+                self.competition, list(self.columns), processor, workers, True
+            )
+        )
+
+    def filter_proposals(self, proposal_filter):
+        """Adds a step that runs Competition.filter_proposals with
+        PROPOSAL_FILTER"""
+        self.steps.append(FilterStep(proposal_filter))
+
+    def sort(self, column_name, is_integer=False):
+        """Adds a step that runs Competition.sort with COLUMN_NAME and
+        IS_INTEGER"""
+        self.steps.append(SortStep(column_name, is_integer))
+
+    def barriers(self):
+        """Returns a list of tuples of the description of each step that
+        can't be run along with the others, and the reason why"""
+        return [(step.description, step.barrier) for step in self.steps if step.barrier]
+
+    def run(self):
+        """Runs the steps, leaving the pipeline empty so that more steps can
+        be added and run"""
+        self.competition.discard_csv()
+        # As proposals go through the steps at different times, virtual
+        # columns that a later step would change are stored from the start,
+        # rather than stored at the time of that step.
+        changed_column_names = set()
+        for step in reversed(self.steps):
+            if isinstance(step, AdderStep):
+                step.store_virtual_columns(changed_column_names)
+            changed_column_names.update(step.changed_column_names)
+
+        fused_steps = []
+        for step in self.steps:
+            if step.barrier is None:
+                fused_steps.append(step)
+                continue
+
+            self.run_fused(fused_steps)
+            fused_steps = []
+            step.run_alone(self.competition)
+        self.run_fused(fused_steps)
+        self.steps = []
+
+    def run_fused(self, steps):
+        """Runs STEPS, none of which are barriers, in one pass over the
+        proposals"""
+        if not steps:
+            return
+
+        competition = self.competition
+        for step in steps:
+            step.prepare(competition)
+
+        for key, proposal in competition.proposals.items():
+            for step in steps:
+                if not step.run(competition, key, proposal):
+                    break
+
+        # Play the filters and sorts back in order, with what they found
+        # for each proposal, which ends up with the same order as running
+        # them one at a time.
+        proposal_keys = list(competition.proposals)
+        sorted_proposal_keys = competition.sorted_proposal_keys
+        filtered = False
+        for step in steps:
+            if isinstance(step, SortStep):
+                sorted_proposal_keys = sorted(
+                    proposal_keys, key=step.sort_values.__getitem__
+                )
+            elif isinstance(step, FilterStep):
+                sorted_proposal_keys = [
+                    key for key in sorted_proposal_keys if key not in step.filtered_keys
+                ]
+                proposal_keys = sorted_proposal_keys
+                filtered = True
+
+        competition.sorted_proposal_keys = sorted_proposal_keys
+        if filtered:
+            competition.proposals = {
+                key: competition.proposals[key] for key in sorted_proposal_keys
+            }
+            if competition.storage is not None:
+                competition.storage.compact(competition.proposals.values())
+
+
+class AdderStep:
+    """A step in a Pipeline that adds information with ADDER to
+    COMPETITION"""
+
+    def __init__(self, competition, adder):
+        self.adder = adder
+        self.column_names = adder.column_names()
+        self.changed_column_names = self.column_names
+        self.virtual_columns = competition.virtual_columns_for(adder)
+        self.stored_column_names = [
+            column_name
+            for column_name in self.column_names
+            if column_name not in self.virtual_columns
+        ]
+        self.description = adder_step_description(adder, self.column_names)
+        self.barrier = None
+        if adder.needs_all_proposals():
+            self.barrier = "%s needs all proposals" % type(adder).__name__
+
+    def store_virtual_columns(self, column_names):
+        """Stores the cells of the virtual columns that would change along
+        with COLUMN_NAMES, rather than keeping them virtual"""
+        self.virtual_columns = {
+            column_name: virtual_column
+            for (column_name, virtual_column) in self.virtual_columns.items()
+            if not virtual_column.affected_by(column_names)
+        }
+        self.stored_column_names = [
+            column_name
+            for column_name in self.column_names
+            if column_name not in self.virtual_columns
+        ]
+
+    def prepare(self, competition):
+        """Adds the columns, with their types, to COMPETITION"""
+        competition.materialize_virtual_columns(self.column_names, self.virtual_columns)
+        competition.add_columns(self.adder, self.column_names, self.virtual_columns)
+
+    def run(self, competition, key, proposal):
+        """Adds the cells to PROPOSAL, with KEY, in COMPETITION, and returns
+        True, as it's kept"""
+        if not competition.reuse_cells(
+            key,
+            proposal,
+            self.description,
+            self.stored_column_names,
+            self.adder,
+        ):
+            cells = self.adder.cells(proposal, self.stored_column_names)
+            for column_name in self.stored_column_names:
+                proposal.add_cell(column_name, cells[column_name])
+            competition.record_cells(
+                key, proposal, self.description, self.stored_column_names, self.adder
+            )
+        return True
+
+    def run_alone(self, competition):
+        """Runs the step over all of COMPETITION"""
+        competition.add_supplemental_information(self.adder)
+
+
+class ProcessorStep:
+    """A step in a Pipeline that runs PROCESSOR over COLUMN_NAMES, which is
+    all of the columns when ALL_COLUMNS.  WORKERS is as in
+    Competition.process_cells_special, and makes the step a barrier when
+    the processor can be run in a pool of processes."""
+
+    def __init__(
+        self, competition, column_names, processor, workers, all_columns=False
+    ):
+        self.column_names = column_names
+        self.changed_column_names = column_names
+        self.processor = processor
+        self.workers = workers
+        self.all_columns = all_columns
+        self.description = processor_step_description(processor, column_names)
+        self.barrier = None
+        if processor.needs_all_proposals():
+            self.barrier = "%s needs all proposals" % type(processor).__name__
+        elif competition.can_process_in_pool(
+            processor, workers, list(competition.proposals.values())
+        ):
+            self.barrier = "%s runs in a pool of %d processes" % (
+                type(processor).__name__,
+                workers,
+            )
+
+    def prepare(self, competition):
+        """Sets the column types in COMPETITION, and stores the virtual
+        columns that the step changes"""
+        competition.materialize_virtual_columns(self.column_names)
+        if self.processor.column_type() is not None:
+            for column_name in self.column_names:
+                competition.column_types[column_name] = self.processor.column_type()
+
+    def run(self, competition, key, proposal):
+        """Processes the cells of PROPOSAL, with KEY, in COMPETITION, and
+        returns True, as it's kept"""
+        if not competition.reuse_cells(
+            key,
+            proposal,
+            self.description,
+            self.column_names,
+            self.processor,
+        ):
+            for column_name in self.column_names:
+                proposal.process_cell_special(column_name, self.processor)
+            competition.record_cells(
+                key, proposal, self.description, self.column_names, self.processor
+            )
+        return True
+
+    def run_alone(self, competition):
+        """Runs the step over all of COMPETITION"""
+        if self.all_columns:
+            competition.process_all_cells_special(self.processor, self.workers)
+        else:
+            competition.process_cells_special(
+                self.column_names[0], self.processor, self.workers
+            )
+
+
+class FilterStep:
+    """A step in a Pipeline that filters proposals with PROPOSAL_FILTER"""
+
+    def __init__(self, proposal_filter):
+        self.proposal_filter = proposal_filter
+        self.description = "filter %s" % type(proposal_filter).__name__
+        self.changed_column_names = []
+        self.barrier = None
+        self.filtered_keys = set()
+
+    def prepare(self, competition):
+        """Nothing needs to be set up in COMPETITION for this step"""
+        pass
+
+    def run(self, competition, key, proposal):
+        """Returns whether PROPOSAL, with KEY, is kept, remembering it if it
+        isn't"""
+        if self.proposal_filter.filter_proposal(proposal):
+            self.filtered_keys.add(key)
+            return False
+        return True
+
+    def run_alone(self, competition):
+        """Runs the step over all of COMPETITION"""
+        competition.filter_proposals(self.proposal_filter)
+
+
+class SortStep:
+    """A step in a Pipeline that sorts the proposals by COLUMN_NAME, as
+    in Competition.sort.  Only the values to sort by are collected as the
+    proposals go through the pipeline, and the sorting happens at the
+    end."""
+
+    def __init__(self, column_name, is_integer):
+        self.column_name = column_name
+        self.is_integer = is_integer
+        self.description = "sort %r" % column_name
+        self.changed_column_names = []
+        self.barrier = None
+        self.sort_values = {}
+
+    def prepare(self, competition):
+        """Nothing needs to be set up in COMPETITION for this step"""
+        pass
+
+    def run(self, competition, key, proposal):
+        """Remembers the value PROPOSAL, with KEY, is sorted by, and returns
+        True, as it's kept"""
+        value = proposal.cell(self.column_name)
+        self.sort_values[key] = int(value) if self.is_integer else value
+        return True
+
+    def run_alone(self, competition):
+        """Runs the step over all of COMPETITION"""
+        competition.sort(self.column_name, self.is_integer)
+
 
 class Proposal:
     """A Proposal, of which there are many in a competition.  A Proposal
     loosely represents one row in the master spreadsheet, but provides
     indexing based on names, ability to add new fields, etc"""
 
-    def __init__(self, column_names, row, key_column_name):
+    def __init__(self, column_names, row, key_column_name, virtual_columns=None):
         """COLUMN_NAMES are the list of columns that came from the
         initial spreadsheet, while ROW is the value for this proposal.
         KEY_COLUMN_NAME is used to later get the key of this proposal.
+        VIRTUAL_COLUMNS, when passed in, is the competition's dict of
+        VirtualColumns, which is checked for the columns the proposal doesn't
+        have its own cell for.  A column is never both, so cells that are
+        stored cost no more to read than without virtual columns.
 
         This sets up the proposal by processing the initial row"""
         self.data = dict(zip(column_names, row))
         self.key_column_name = key_column_name
+        self.virtual_columns = virtual_columns
 
     def add_cell(self, column_name, cell):
         """Adds a new value CELL to the place held by COLUMN_NAME"""
@@ -198,6 +895,8 @@ class Proposal:
         """Returns the cell value for COLUMN_NAME"""
         if column_name in self.data:
             return self.data[column_name]
+        if self.virtual_columns and column_name in self.virtual_columns:
+            return self.virtual_columns[column_name].cell(self)
 
     def key(self):
         """Returns the key for this Proposal"""
@@ -209,6 +908,38 @@ class Proposal:
         return [self.cell(column_name) for column_name in column_names]
 
 
+class VirtualColumn:
+    """A column added by ADDER whose cells are worked out when they're read,
+    see InformationAdder.virtual_columns.  COLUMN_NAME is the column, and
+    its cells are worked out from INPUT_COLUMNS and KEY_COLUMN_NAME."""
+
+    def __init__(self, adder, column_name, input_columns, key_column_name):
+        self.adder = adder
+        self.column_name = column_name
+        self.input_columns = set(input_columns)
+        self.input_columns.add(key_column_name)
+        self.memoized_cells = None
+        if adder.memoize_virtual_cells():
+            self.memoized_cells = {}
+
+    def affected_by(self, column_names):
+        """Returns whether the cells would change if the set COLUMN_NAMES
+        changed"""
+        if self.column_name in column_names:
+            return True
+        return not self.input_columns.isdisjoint(column_names)
+
+    def cell(self, proposal):
+        """Returns the cell for PROPOSAL"""
+        if self.memoized_cells is None:
+            return self.adder.cell(proposal, self.column_name)
+
+        key = proposal.key()
+        if key not in self.memoized_cells:
+            self.memoized_cells[key] = self.adder.cell(proposal, self.column_name)
+        return self.memoized_cells[key]
+
+
 class ProposalFilter:
     """The base class for Proposal Filters, which will usually implement
     filter_proposal"""
@@ -243,6 +974,18 @@ class ColumnNotEqualsProposalFilter(ProposalFilter):
         return proposal.cell(self.column_name) != self.value
 
 
+class KeySetProposalFilter(ProposalFilter):
+    """A filter for proposals whose key isn't in the KEYS passed in.  Useful
+    as the ROW_FILTER of a Competition when the keys that will be uploaded
+    are known up front."""
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+
+    def filter_proposal(self, proposal):
+        return proposal.key() not in self.keys
+
+
 class CellProcessor:
     """The base class for Cell Processors, which implement column_type
     and process_cell"""
@@ -257,13 +1000,61 @@ class CellProcessor:
         returns it."""
         return proposal.cell(column_name)
 
+    def fingerprint(self, proposal):
+        """Returns something that changes whenever what this processor would
+        do to PROPOSAL could change, other than by PROPOSAL's own cells
+        changing, for instance its configuration and its data for the
+        proposal.  Used by incremental runs (see
+        Competition.enable_incremental) to skip processing unchanged
+        proposals.  It needs a stable repr, like a string, or a list or dict
+        of strings.  Returns None if it can't tell, in which case the cells
+        are always processed."""
+        return None
+
+    def proposal_report(self, key):
+        """Returns what this processor has to report about the proposal with
+        KEY, like the number of cells it changed, which incremental runs keep
+        with the cells so that reusing them reports the same as processing
+        them.  It needs to be picklable.  None if there's nothing."""
+        return None
+
+    def keep_proposal_report(self, key, report):
+        """Takes REPORT, from proposal_report, as the report for the proposal
+        with KEY, in place of anything this processor had for it"""
+        pass
+
+    def needs_all_proposals(self):
+        """Returns whether what this processor does to a proposal depends on
+        the other proposals, so that every proposal has to have been through
+        the steps before it first.  When it does, it's a barrier in a
+        Pipeline."""
+        return False
+
+    def worker_copy(self):
+        """Returns the processor to send to a worker process when processing
+        cells in a pool.  Processors that collect state as they go should
+        return a copy without that state, so that it isn't counted twice
+        when merged back in."""
+        return self
+
+    def merge(self, other):
+        """Folds the state of OTHER, a worker_copy of this processor that has
+        processed some of the proposals in a worker process, back in to this
+        one.  Called in proposal order."""
+        pass
+
 
 class FixCellProcessor(CellProcessor):
     """A CellProcessor that calls utils.fix_cell on the cells affected.
-    That function cleans up irregular data"""
+    That function cleans up irregular data.
 
-    def __init__(self):
+    CACHE, if given, is a cache.CellCache created with
+    utils.fix_cell_version, which is checked before calling fix_cell.
+    It's up to the caller to save it afterward."""
+
+    def __init__(self, cache=None):
         self.processed_cells = {}
+        self.cache = cache
 
     def process_cell(self, proposal, column_name):
         key = proposal.key()
@@ -271,12 +1062,43 @@ class FixCellProcessor(CellProcessor):
             self.processed_cells[key] = {"cols": 0, "fixed": 0}
 
         cell = proposal.cell(column_name)
-        fixed_cell = utils.fix_cell(cell)
+        fixed_cell = None
+        if self.cache is not None:
+            fixed_cell = self.cache.get(cell)
+        if fixed_cell is None:
+            fixed_cell = utils.fix_cell(cell)
+            if self.cache is not None:
+                self.cache.put(cell, fixed_cell)
         self.processed_cells[key]["cols"] += 1
         if fixed_cell != cell:
             self.processed_cells[key]["fixed"] += 1
         return fixed_cell
 
+    def worker_copy(self):
+        if self.cache is None:
+            return FixCellProcessor()
+        return FixCellProcessor(self.cache.worker_copy())
+
+    def fingerprint(self, proposal):
+        return utils.fix_cell_version
+
+    def merge(self, other):
+        if self.cache is not None:
+            self.cache.merge(other.cache)
+        for key, report in other.processed_cells.items():
+            if key not in self.processed_cells:
+                self.processed_cells[key] = {"cols": 0, "fixed": 0}
+            self.processed_cells[key]["cols"] += report["cols"]
+            self.processed_cells[key]["fixed"] += report["fixed"]
+
+    def proposal_report(self, key):
+        return self.processed_cells.get(key)
+
+    def keep_proposal_report(self, key, report):
+        self.processed_cells.pop(key, None)
+        if report is not None:
+            self.processed_cells[key] = report
+
     def report(self):
         for key, report in self.processed_cells.items():
             print(
@@ -292,6 +1114,9 @@ class RemoveHTMLBRsProcessor(CellProcessor):
     def __init__(self, replacement_string=""):
         self.replacement_string = replacement_string
 
+    def fingerprint(self, proposal):
+        return self.replacement_string
+
     def process_cell(self, proposal, column_name):
         # Because of how fix_cell works, we have to remove both the <br> and the \n separately
         return (
@@ -309,6 +1134,9 @@ class MultiLineProcessor(CellProcessor):
     def __init__(self, split_string=","):
         self.split_string = split_string
 
+    def fingerprint(self, proposal):
+        return self.split_string
+
     def column_type(self):
         return "list"
 
@@ -325,6 +1153,9 @@ class MultiLineFromListProcessor(CellProcessor):
     def __init__(self, valid_list):
         self.valid_list = valid_list
 
+    def fingerprint(self, proposal):
+        return self.valid_list
+
     def column_type(self):
         return "list"
 
@@ -374,6 +1205,9 @@ class AnnualBudgetProcessor(CellProcessor):
         # as the key makes the client look nicer.
         self.reverse_mapping = {v: k for k, v in mapping.items()}
 
+    def fingerprint(self, proposal):
+        return {v: k.value for v, k in self.reverse_mapping.items()}
+
     def process_cell(self, proposal, column_name):
         cell = proposal.cell(column_name)
         if cell not in self.reverse_mapping:
@@ -411,6 +1245,9 @@ class SustainableDevelopmentGoalProcessor(CellProcessor):
     def __init__(self, sdg_list):
         self.reverse_mapping = {v: idx for idx, v in enumerate(sdg_list)}
 
+    def fingerprint(self, proposal):
+        return self.reverse_mapping
+
     def process_cell(self, proposal, column_name):
         cell = proposal.cell(column_name)
 
@@ -444,6 +1281,9 @@ class BudgetTableProcessor(CellProcessor):
             )
         return json.dumps(budget_row_data)
 
+    def fingerprint(self, proposal):
+        return ""
+
 
 class NumberCommaizer(CellProcessor):
     """A CellProcessor that takes large numbers and inserts commas where appropriate,
@@ -458,6 +1298,9 @@ class NumberCommaizer(CellProcessor):
 
         return utils.commaize_number(proposal.cell(column_name))
 
+    def fingerprint(self, proposal):
+        return ""
+
 
 class CorrectionData(CellProcessor):
     """A CellProcessor that's generated from a csv file that has a row
@@ -470,25 +1313,33 @@ class CorrectionData(CellProcessor):
     2,Correct Title for 2,,...   # There is no entry for Organization,
                                  # so no correction is made
 
-    Will then replace cells in the proposals with the updated version."""
+    Will then replace cells in the proposals with the updated version.
 
-    def __init__(self, key_column_name, correction_csv):
-        self.correction_data = {}
+    PARE, when passed in, is the competition's pare, and the rows for the
+    proposals it doesn't include are skipped."""
 
-        csv_reader = csv.reader(
-            open(correction_csv, encoding="utf-8"), delimiter=",", quotechar='"'
-        )
-        self.header = next(csv_reader)
-        key_col_idx = self.header.index(key_column_name)
-
-        for correction_row in csv_reader:
-            key = correction_row[key_col_idx]
-            if key not in self.correction_data:
-                self.correction_data[key] = {}
-            for col_name, datum in zip(self.header, correction_row):
-                # If empty, or the key column, don't correct
-                if col_name != key_column_name and datum:
-                    self.correction_data[key][col_name] = datum
+    def __init__(self, key_column_name, correction_csv, pare=None):
+        self.key_column_name = key_column_name
+        self.header = join.read_header(correction_csv)
+        self.correction_data = join.SideSheet(
+            correction_csv,
+            key_column_name,
+            mode=join.AGGREGATE,
+            aggregate=self.add_corrections,
+            pare=pare,
+        ).rows
+
+    def add_corrections(self, corrections, correction_row):
+        """Adds the corrections in CORRECTION_ROW to CORRECTIONS, the ones
+        for the same proposal from the rows before it (None for the first
+        one), and returns them"""
+        if corrections is None:
+            corrections = {}
+        for col_name, datum in zip(self.header, correction_row):
+            # If empty, or the key column, don't correct
+            if col_name != self.key_column_name and datum:
+                corrections[col_name] = datum
+        return corrections
 
     def columns_affected(self):
         """Get all the columns this correction file corrects.  This can
@@ -505,6 +1356,9 @@ class CorrectionData(CellProcessor):
 
         return proposal.cell(column_name)
 
+    def fingerprint(self, proposal):
+        return self.correction_data.get(proposal.key(), {})
+
 
 class ColumnTypeUpdater(CellProcessor):
     """This doesn't actually process the cell, but adds a column type
@@ -517,6 +1371,9 @@ class ColumnTypeUpdater(CellProcessor):
     def column_type(self):
         return self.col_type
 
+    def fingerprint(self, proposal):
+        return ""
+
 
 class DefaultValueSetter(CellProcessor):
     """Sets the value to DEFAULT_VALUE if no value set there already."""
@@ -527,11 +1384,14 @@ class DefaultValueSetter(CellProcessor):
     def process_cell(self, proposal, column_name):
         return proposal.cell(column_name) or self.default_value
 
+    def fingerprint(self, proposal):
+        return self.default_value
+
 
 class InformationAdder:
     """The base class for things that add information to proposals that
     aren't in the base spreadsheet.  Will usually implement column_type,
-    names, and cell"""
+    names, and cell, and sometimes cells"""
 
     def column_type(self, column_name):
         """Returns the column type for the COLUMN_NAME that would have
@@ -549,8 +1409,108 @@ class InformationAdder:
         can use other information within the PROPOSAL."""
         pass
 
+    def cells(self, proposal, column_names):
+        """Returns a dict of the new cells for the proposal PROPOSAL, by
+        column name, for COLUMN_NAMES, which are some of the column names
+        this adder adds.  All of the cells are worked out before any of
+        them are added to PROPOSAL.
+
+        By default this calls cell for each column, but adders that do the
+        same work for every column of a proposal (looking the proposal up
+        in their data, say) can implement this to only do it once."""
+        return {
+            column_name: self.cell(proposal, column_name)
+            for column_name in column_names
+        }
+
+    def fingerprint(self, proposal):
+        """Returns something that changes whenever the cells this adder would
+        add to PROPOSAL could change, other than by PROPOSAL's own cells
+        changing, for instance the adder's data for the proposal.  See
+        CellProcessor.fingerprint, which this is the same as."""
+        return None
+
+    def proposal_report(self, key):
+        """See CellProcessor.proposal_report, which this is the same as"""
+        return None
+
+    def keep_proposal_report(self, key, report):
+        """See CellProcessor.keep_proposal_report, which this is the same as"""
+        pass
+
+    def needs_all_proposals(self):
+        """Returns whether the cells this adder adds to a proposal depend on
+        the other proposals.  See CellProcessor.needs_all_proposals, which
+        this is the same as."""
+        return False
+
+    def virtual_columns(self):
+        """Returns a dict of the columns, out of column_names, whose cells
+        shouldn't be stored in every proposal, but worked out with cell
+        whenever they're read.  The values are lists of the other columns
+        that the cells are worked out from (the key column always counts).
+        That's meant for columns that are constant, or cheap to work out,
+        or memoized (see memoize_virtual_cells).
+
+        When a processor or another adder is about to change a virtual
+        column, or the columns it's worked out from, the competition stores
+        its cells first, so the result is the same as if they were stored
+        from the start."""
+        return {}
+
+    def memoize_virtual_cells(self):
+        """Returns whether the cells of the virtual columns (see
+        virtual_columns) should be kept after the first time they're read
+        for a proposal, rather than worked out every time"""
+        return False
+
+
+class SideSheetAdder(InformationAdder, ProposalFilter):
+    """Adder for columns that come straight from SIDE_SHEET, a
+    join.SideSheet joined ONE_TO_ONE.  COLUMNS is a dict from the names of
+    the columns to add to the columns of the side sheet they come from.
+    COLUMN_TYPES, when passed in, is a dict from the names of the columns
+    to add to their types.  Proposals that aren't in the side sheet get
+    MISSING_CELL.
+
+    It's also a filter for the proposals that aren't in the side sheet."""
+
+    def __init__(self, side_sheet, columns, column_types=None, missing_cell=""):
+        self.side_sheet = side_sheet
+        self.columns = columns
+        self.column_types = column_types or {}
+        self.missing_cell = missing_cell
+
+    def column_type(self, column_name):
+        return self.column_types.get(column_name)
+
+    def column_names(self):
+        return list(self.columns)
+
+    def cell(self, proposal, column_name):
+        return self.side_sheet.cell(
+            proposal.key(), self.columns[column_name], self.missing_cell
+        )
+
+    def cells(self, proposal, column_names):
+        row = self.side_sheet.get(proposal.key())
+        if row is None:
+            return {column_name: self.missing_cell for column_name in column_names}
+
+        column_positions = self.side_sheet.column_positions
+        return {
+            column_name: row[column_positions[self.columns[column_name]]]
+            for column_name in column_names
+        }
+
+    def fingerprint(self, proposal):
+        return self.side_sheet.get(proposal.key(), ())
 
-class LinkedSecondSheet(InformationAdder):
+    def filter_proposal(self, proposal):
+        return proposal.key() not in self.side_sheet
+
+
+class LinkedSecondSheet(SideSheetAdder):
     """Adder in the case that there's a second sheet that has one proposal
     per row, like the original sheet, and has information that should
     get added."""
@@ -560,10 +1520,12 @@ class LinkedSecondSheet(InformationAdder):
         csv_location,
         key_column_name,
         additional_columns,
+        pare=None,
     ):
         """Builds the dataset from the CSV_LOCATION, using the KEY_COLUMN_NAME
         to link up against the proposal keys, and the adds the columns from
-        ADDITIONAL_COLUMN
+        ADDITIONAL_COLUMN.  The rows for proposals that PARE, the
+        competition's pare if passed in, doesn't include are skipped.
 
         ADDITIONAL_COLUMN is a list of objects of the form:
         {
@@ -572,14 +1534,7 @@ class LinkedSecondSheet(InformationAdder):
                          in the final csv.  If omited, source_name is used
           "type": a string, the type of the column, optional
         }"""
-        csv_reader = csv.reader(
-            open(csv_location, encoding="utf-8"), delimiter=",", quotechar='"'
-        )
-        header_row = next(csv_reader)
-
-        key_col_idx = header_row.index(key_column_name)
         self.additional_columns = additional_columns
-        self.data = {}
 
         additional_columns = [
             {
@@ -591,34 +1546,34 @@ class LinkedSecondSheet(InformationAdder):
             }
             for col in additional_columns
         ]
-        for row in csv_reader:
-            self.data[row[key_col_idx]] = {
-                col["target_name"]: row[header_row.index(col["source_name"])]
-                for col in additional_columns
-            }
-        self.additional_column_types = {
-            col["target_name"]: col["type"] for col in additional_columns
-        }
-        self.additional_column_names = [
-            col["target_name"] for col in additional_columns
-        ]
-
-    def column_type(self, column_name):
-        if column_name in self.additional_column_types.keys():
-            return self.additional_column_types[column_name]
-        return None
-
-    def column_names(self):
-        return self.additional_column_names
+        super().__init__(
+            join.SideSheet(
+                csv_location,
+                key_column_name,
+                [col["source_name"] for col in additional_columns],
+                pare=pare,
+            ),
+            {col["target_name"]: col["source_name"] for col in additional_columns},
+            {col["target_name"]: col["type"] for col in additional_columns},
+        )
 
     def cell(self, proposal, column_name):
-        if proposal.key() in self.data and column_name in self.data[proposal.key()]:
-            return self.data[proposal.key()][column_name]
+        if proposal.key() in self.side_sheet:
+            return super().cell(proposal, column_name)
         elif proposal.cell(column_name):
             return proposal.cell(column_name)
 
         return ""
 
+    def cells(self, proposal, column_names):
+        if proposal.key() in self.side_sheet:
+            return super().cells(proposal, column_names)
+
+        return {
+            column_name: proposal.cell(column_name) or ""
+            for column_name in column_names
+        }
+
 
 class MediaWikiTitleAdder(InformationAdder):
     """An InformationAdder that adds the MediaWiki Title column, which
@@ -639,6 +1594,18 @@ class MediaWikiTitleAdder(InformationAdder):
         title = "%s (%s)" % (proposal.cell(self.project_column_name), proposal.key())
         return self.sanitize_title(title)
 
+    def fingerprint(self, proposal):
+        return self.project_column_name
+
+    def virtual_columns(self):
+        return {
+            column_name: [self.project_column_name]
+            for column_name in self.column_names()
+        }
+
+    def memoize_virtual_cells(self):
+        return True
+
     def sanitize_title(self, title):
         import unidecode
 
@@ -688,60 +1655,34 @@ class StaticColumnAdder(InformationAdder):
     def cell(self, proposal, column_name):
         return self.value
 
+    def fingerprint(self, proposal):
+        return self.value
 
-class FinancialDataAdder(InformationAdder):
-    """Adder that takes a FINANCIAL_SHEETS_DIR, filled with csvs named
-    <Application #>.csv, as well as a DEFINITIONS dictionary that
-    determines how those are converted into a "LFC Financial Data"
-    field, of type json.  If the proposal number is not in the
-    FINANCIAL_SHEETS_DIR, then the empty object will be passed up.
-
-    The DEFINITIONS will be a list of definitions, of the form:
-
-    {
-        "name": String, the name in the eventual json
-        "text": String, the text of the first column to match against
-        "percent": Boolean, whether these numbers are percents or not.
-                   Defaults to False
-    }
-
-    The csv coming in should be of the type:
-
-    <ignored>,year1,year2,year3,...
-    <item1>,val,val,val,...
-    <item2>,val,val,val,...
-    <item3>,val,val,val,...
-    ,,,,
-    Footnotes
-    footnote1
-    footnote2
-    ...
-
-    Where the <item>s match the definition "text" exactly, and there are N
-    footnotes.
+    def virtual_columns(self):
+        return {self.column_name: []}
 
-    The exporting format is of the form:
 
-    {
-       "years": Array, list of years
-       "line_items": {
-           "name": name mathing the "name" field in the DEFINITIONS (above)
-           "data": Array of strings, list of Strings representing the data on those years
-       }
-       "footnoates": String, with a newline separated set of footnotes
-    }"""
-
-    def __init__(self, financial_sheets_dir, definitions):
-        self.financial_data = {}
+class FinancialSheetParser:
+    """Parses a financial sheet csv for FinancialDataAdder (see there for
+    the DEFINITIONS and the formats), when called with its location.  A
+    class rather than a closure so that it can be sent to other processes."""
 
-        for financial_csv_name in os.listdir(financial_sheets_dir):
-            key = re.sub("\.csv$", "", financial_csv_name)
-            financial_csv_file = os.path.join(financial_sheets_dir, financial_csv_name)
+    def __init__(self, definitions):
+        # Later definitions for the same text win, as they always have
+        self.definitions = {}
+        for definition in definitions:
+            if "name" not in definition or "text" not in definition:
+                raise Exception(
+                    "Definition %s needs a name and a text.  Aborting." % definition
+                )
+            self.definitions[definition["text"]] = definition
 
-            proposal_financial_data = {}
+    def __call__(self, financial_csv_file):
+        proposal_financial_data = {}
 
+        with open(financial_csv_file) as f:
             reader = csv.reader(
-                open(financial_csv_file),
+                f,
                 delimiter=",",
                 quotechar='"',
                 lineterminator="\n",
@@ -758,11 +1699,7 @@ class FinancialDataAdder(InformationAdder):
                     break
 
                 item_string = row[0]
-                definition = None
-
-                for defi in definitions:
-                    if defi["text"] == item_string.strip():
-                        definition = defi
+                definition = self.definitions.get(item_string.strip())
 
                 if definition is None:
                     raise Exception(
@@ -794,14 +1731,91 @@ class FinancialDataAdder(InformationAdder):
                     if len(row) > 0 and row[0] == "Footnotes":
                         break
 
-            footnotes = ""
-            for row in reader:
-                if len(row) > 0 and row[0]:
-                    footnotes += utils.fix_cell(row[0] + "\n")
+            proposal_financial_data["footnotes"] = "".join(
+                utils.fix_cell(row[0] + "\n")
+                for row in reader
+                if len(row) > 0 and row[0]
+            )
 
-            proposal_financial_data["footnotes"] = footnotes
+        return proposal_financial_data
 
-            self.financial_data[key] = proposal_financial_data
+
+class FinancialDataAdder(InformationAdder):
+    """Adder that takes a FINANCIAL_SHEETS_DIR, filled with csvs named
+    <Application #>.csv, as well as a DEFINITIONS dictionary that
+    determines how those are converted into a "LFC Financial Data"
+    field, of type json.  If the proposal number is not in the
+    FINANCIAL_SHEETS_DIR, then the empty object will be passed up.
+
+    The DEFINITIONS will be a list of definitions, of the form:
+
+    {
+        "name": String, the name in the eventual json
+        "text": String, the text of the first column to match against
+        "percent": Boolean, whether these numbers are percents or not.
+                   Defaults to False
+    }
+
+    The csv coming in should be of the type:
+
+    <ignored>,year1,year2,year3,...
+    <item1>,val,val,val,...
+    <item2>,val,val,val,...
+    <item3>,val,val,val,...
+    ,,,,
+    Footnotes
+    footnote1
+    footnote2
+    ...
+
+    Where the <item>s match the definition "text" exactly, and there are N
+    footnotes.
+
+    The exporting format is of the form:
+
+    {
+       "years": Array, list of years
+       "line_items": {
+           "name": name mathing the "name" field in the DEFINITIONS (above)
+           "data": Array of strings, list of Strings representing the data on those years
+       }
+       "footnoates": String, with a newline separated set of footnotes
+    }"""
+
+    def __init__(
+        self,
+        financial_sheets_dir,
+        definitions,
+        keys=None,
+        workers=1,
+        cache_location=None,
+        pare=None,
+    ):
+        """The csvs are parsed when they're first needed, unless KEYS are
+        passed in, in which case the csvs for those are parsed up front,
+        across a pool of WORKERS processes.  If CACHE_LOCATION is passed in,
+        what's parsed is cached there for later runs (see files.KeyedFiles).
+        The csvs for proposals that PARE, the competition's pare if passed
+        in, doesn't include are left out.
+
+        The DEFINITIONS are checked here, but a line item without a
+        definition is only found when its csv is parsed, so pass KEYS for
+        that to stop the run before any of the proposals are processed."""
+        locations = {}
+        for financial_csv_name in os.listdir(financial_sheets_dir):
+            key = re.sub("\\.csv$", "", financial_csv_name)
+            if pare is not None and not pare.includes(key):
+                continue
+            locations[key] = os.path.join(financial_sheets_dir, financial_csv_name)
+
+        self.financial_data = files.KeyedFiles(
+            locations,
+            FinancialSheetParser(definitions),
+            cache_location,
+            incremental.digest(incremental.pipeline_version(), definitions),
+        )
+        if keys is not None:
+            self.financial_data.load(keys, workers)
 
     def column_type(self, column_name):
         return "json"
@@ -812,6 +1826,9 @@ class FinancialDataAdder(InformationAdder):
     def cell(self, proposal, column_name):
         return json.dumps(self.financial_data.get(proposal.key(), {}))
 
+    def fingerprint(self, proposal):
+        return self.financial_data.get(proposal.key(), {})
+
 
 class GlobalViewMediaWikiTitleAdder(MediaWikiTitleAdder):
     """A MediaWikiTitleAdder that has a different title layout because it's tailored
@@ -832,18 +1849,28 @@ class GlobalViewMediaWikiTitleAdder(MediaWikiTitleAdder):
         )
         return self.sanitize_title(title)
 
+    def fingerprint(self, proposal):
+        return [self.wiki_key, self.project_column_name]
+
 
-@total_ordering
 class Attachment:
     """Represents an attachment on the file system, and handles special cases
-    about display names to make sure things show up correctly"""
+    about display names to make sure things show up correctly.
+
+    The attachment is at PATH, unless ARCHIVE, a scan.AttachmentArchive, is
+    passed in, in which case PATH is the name of the attachment in it.
+
+    Attachments are sorted by sort_key."""
 
-    def __init__(self, key, filename, column_name, path):
+    def __init__(self, key, filename, column_name, path, archive=None):
         self.file = filename
         self.rank = None
         self.key = key
         self.path = path
+        self.archive = archive
         self.column_name = column_name
+        # The patterns of the AttachmentRules that matched, in order
+        self.rules = []
         self.name = re.sub("^\\d*_", "", filename)
         self.name = re.sub("\.pdf$", "", self.name)
         if len(self.name) > 33:
@@ -855,18 +1882,150 @@ class Attachment:
     def __ne__(self, other):
         return self.rank != other.rank or self.name != other.name
 
-    def __gt__(self, other):
-        if self.rank is other.rank:
-            return self.name > other.name
-
+    def open(self):
+        """Returns a binary stream of the contents of the attachment"""
+        if self.archive is not None:
+            return self.archive.open(self.path)
+        return open(self.path, "rb")
+
+    def size(self):
+        """Returns the size of the contents of the attachment, in bytes"""
+        if self.archive is not None:
+            return self.archive.open_archive().getinfo(self.path).file_size
+        return os.path.getsize(self.path)
+
+    def sort_key(self):
+        """Returns the key to sort this attachment by, which is by rank and
+        then by name, with the unranked ones at the end"""
         # Sort unranked things to the bottom
         if self.rank is None:
-            return True
+            return (1, 0, self.name)
+        return (0, self.rank, self.name)
+
+
+class AttachmentRules:
+    """An ordered table of rules for classifying attachments by their file
+    names, for RegexSpecifiedAttachments.apply_rules.  The rules are added
+    with specify_by_regex and specify_new_column, which are the same as the
+    methods of RegexSpecifiedAttachments, and each is a tuple of (PATTERN,
+    NAME, RANK, COLUMN_NAME, IS_LIST), where NAME and COLUMN_NAME are None
+    when the rule doesn't change them.
+
+    Every rule whose PATTERN is found in the file name, case insensitively,
+    applies to an attachment, in order, so where rules change the same
+    thing, the last one wins.  Each PATTERN is compiled once, along with a
+    piece of plain text that anything it matches has to contain (see
+    required_literal), and a rule's regex is only run over the file names
+    that have that text in them, which for most rules and file names is
+    none of them."""
 
-        if other.rank is None:
-            return False
+    def __init__(self):
+        self.rules = []
+        self.compiled_rules = None
 
-        return self.rank > other.rank
+    def specify_by_regex(self, regex, name, rank=None):
+        """Adds a rule that sets the display name of the attachments that
+        REGEX matches to NAME, and the rank to RANK"""
+        self.rules.append((regex, name, rank, None, False))
+        self.compiled_rules = None
+
+    def specify_new_column(self, regex, column_name, rank=None, is_list=False):
+        """Adds a rule that sets the rank of the attachments that REGEX
+        matches to RANK, and links them to the column COLUMN_NAME, which is
+        a list column if IS_LIST"""
+        self.rules.append((regex, None, rank, column_name, is_list))
+        self.compiled_rules = None
+
+    def matching_rules(self, filename):
+        """Returns the rules that match FILENAME, in order"""
+        if self.compiled_rules is None:
+            self.compiled_rules = [
+                (rule, re.compile(rule[0], re.I), required_literal(rule[0]))
+                for rule in self.rules
+            ]
+
+        # The plain text is only compared case insensitively with lower for
+        # ascii file names, as re.I has a few more letters that are the
+        # same as ascii ones, like the Kelvin sign
+        if filename.isascii():
+            lowered = filename.lower()
+            return [
+                rule
+                for (rule, regex, literal) in self.compiled_rules
+                if literal in lowered and regex.search(filename)
+            ]
+        return [
+            rule
+            for (rule, regex, literal) in self.compiled_rules
+            if regex.search(filename)
+        ]
+
+
+def required_literal(pattern):
+    """Returns the longest piece of plain ascii text, lower cased, that
+    anything the regex PATTERN matches has to contain, or "" if that can't
+    be told.  Only the text outside of groups is looked at, and none at
+    all if there's an alternation outside of groups, so it's conservative:
+    ".*Finalist Memo.*" gives "finalist memo", "^\\d*_team" gives "_team" and
+    "(a|b)c" gives "c"."""
+    if re.compile(pattern).flags & re.VERBOSE:
+        return ""
+
+    literals = []
+    run = ""
+    # Whether the last thing was a character added to run, which a
+    # quantifier after it would make optional
+    last_literal = False
+    depth = 0
+    idx = 0
+    while idx < len(pattern):
+        char = pattern[idx]
+        literal = None
+        if char == "\\":
+            escaped = pattern[idx + 1 : idx + 2]
+            if escaped and not escaped.isalnum():
+                literal = escaped
+            idx += 2
+        elif char == "[":
+            # Skip over the character class, where a ] first is part of it
+            idx += 1
+            if pattern[idx : idx + 1] == "^":
+                idx += 1
+            if pattern[idx : idx + 1] == "]":
+                idx += 1
+            while idx < len(pattern) and pattern[idx] != "]":
+                idx += 2 if pattern[idx] == "\\" else 1
+            idx += 1
+        elif char in "*?{":
+            if last_literal:
+                run = run[:-1]
+            if char == "{":
+                close = pattern.find("}", idx)
+                if close == -1:
+                    return ""
+                idx = close
+            idx += 1
+        else:
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            elif char == "|" and depth == 0:
+                return ""
+            elif char not in ".^$+|":
+                literal = char
+            idx += 1
+
+        if literal is not None and literal.isascii() and depth == 0:
+            run += literal
+            last_literal = True
+        else:
+            literals.append(run)
+            run = ""
+            last_literal = False
+    literals.append(run)
+
+    return max(literals, key=len).lower()
 
 
 class BasicAttachments(InformationAdder):
@@ -882,43 +2041,88 @@ class BasicAttachments(InformationAdder):
     The column names can be variable based on what attachments are important
     for the competition.
 
-    When rank is unset, attachments move to the end."""
+    When rank is unset, attachments move to the end.
+
+    The attachments are also kept in ATTACHMENTS_BY_KEY, sorted, so that the
+    ones for a proposal don't have to be searched for.  Anything that changes
+    the rank or name of attachments needs to call sort_attachments after."""
 
     defined_column_names = ["Attachment Display Names", "Attachments"]
 
-    def __init__(self, keys, attachments_dir):
+    def __init__(
+        self,
+        keys,
+        attachments_dir,
+        manifest_location=None,
+        workers=scan.DEFAULT_WORKERS,
+        archives=(),
+    ):
+        """Finds the attachments for KEYS in ATTACHMENTS_DIR.  MANIFEST_LOCATION
+        and WORKERS are as in scan.scan_attachments, which does the finding.
+
+        ARCHIVES is a list of the locations of ZIP archives with more
+        attachments in them, laid out the same way (see
+        scan.AttachmentArchive).  Their attachments are read from the
+        archives, so they don't need to be extracted."""
         self.attachments = []
+        self.attachments_by_key = {}
+        self.attachment_files = set()
+        keys = [key for key in keys if re.search("^\\d*$", key)]
 
         # Attachments are always in a directory structure of
         # <attachments_dir>/<application #>/*
         if attachments_dir is not None and os.path.isdir(attachments_dir):
-            for key in keys:
-                if not os.path.isdir(os.path.join(attachments_dir, key)):
-                    continue
-
-                if not re.search("^\\d*$", key):
-                    continue
-
-                full_application_attachment_dir = os.path.join(attachments_dir, key)
-                for attachment_file in os.listdir(full_application_attachment_dir):
-                    if os.path.isdir(
-                        os.path.join(attachments_dir, key, attachment_file)
-                    ):
-                        continue
-
-                    if re.search("^\\d*_Registration.pdf", attachment_file):
-                        continue
-
-                    self.attachments.append(
-                        Attachment(
-                            key,
-                            attachment_file,
-                            BasicAttachments.defined_column_names[1],
-                            os.path.join(
-                                full_application_attachment_dir, attachment_file
-                            ),
-                        )
-                    )
+            for key, attachment_file in scan.scan_attachments(
+                attachments_dir, keys, manifest_location, workers
+            ):
+                self.add_attachment(
+                    key,
+                    attachment_file,
+                    os.path.join(attachments_dir, key, attachment_file),
+                )
+
+        for archive_location in archives:
+            archive = scan.AttachmentArchive(archive_location)
+            for key, attachment_file, member_name in archive.scan_attachments(keys):
+                self.add_attachment(key, attachment_file, member_name, archive)
+
+        for attachment in self.attachments:
+            if attachment.key not in self.attachments_by_key:
+                self.attachments_by_key[attachment.key] = []
+            self.attachments_by_key[attachment.key].append(attachment)
+        self.sort_attachments(self.attachments_by_key)
+
+    def add_attachment(self, key, attachment_file, path, archive=None):
+        """Adds the attachment ATTACHMENT_FILE for KEY, at PATH, in ARCHIVE
+        if passed in, unless it's one that's always left out.  An attachment
+        with the same KEY and ATTACHMENT_FILE as one that's already been
+        added, say from another archive, would be uploaded over it, so it's
+        reported and left out."""
+        if re.search("^\\d*_Registration.pdf", attachment_file):
+            return
+
+        if (key, attachment_file) in self.attachment_files:
+            print(
+                "Duplicate attachment %s for %s in %s, skipping"
+                % (attachment_file, key, archive.location if archive else path)
+            )
+            return
+        self.attachment_files.add((key, attachment_file))
+
+        self.attachments.append(
+            Attachment(
+                key,
+                attachment_file,
+                BasicAttachments.defined_column_names[1],
+                path,
+                archive,
+            )
+        )
+
+    def sort_attachments(self, keys):
+        """Sorts the attachments for each of KEYS in attachments_by_key"""
+        for key in keys:
+            self.attachments_by_key[key].sort(key=Attachment.sort_key)
 
     def column_type(self, column_name):
         # List for both, so we don't need to switch on it
@@ -930,15 +2134,30 @@ class BasicAttachments(InformationAdder):
         return BasicAttachments.defined_column_names
 
     def cell(self, proposal, column_name):
-        attachments = [a for a in self.attachments if a.key == proposal.key()]
-        attachments.sort()
+        return self.attachments_cell(
+            self.attachments_by_column_name(proposal), column_name
+        )
 
+    def cells(self, proposal, column_names):
+        attachments_by_column_name = self.attachments_by_column_name(proposal)
+        return {
+            column_name: self.attachments_cell(attachments_by_column_name, column_name)
+            for column_name in column_names
+        }
+
+    def attachments_by_column_name(self, proposal):
+        """Returns a dict of the attachments for PROPOSAL, sorted, by the
+        name of the column they go in"""
         attachments_by_column_name = {name: [] for name in self.defined_column_names}
-        for attachment in attachments:
+        for attachment in self.attachments_by_key.get(proposal.key(), []):
             if attachment.column_name not in attachments_by_column_name:
                 attachments_by_column_name[attachment.column_name] = []
             attachments_by_column_name[attachment.column_name].append(attachment)
+        return attachments_by_column_name
 
+    def attachments_cell(self, attachments_by_column_name, column_name):
+        """Returns the cell for COLUMN_NAME from ATTACHMENTS_BY_COLUMN_NAME,
+        as returned by attachments_by_column_name"""
         if column_name == self.defined_column_names[0]:
             return "\n".join(
                 [
@@ -958,6 +2177,12 @@ class BasicAttachments(InformationAdder):
         else:
             return ""
 
+    def fingerprint(self, proposal):
+        return [
+            (a.file, a.name, a.rank, a.column_name)
+            for a in self.attachments_by_key.get(proposal.key(), [])
+        ]
+
 
 class RegexSpecifiedAttachments(BasicAttachments):
     """A special case of BasicAttachments with the ability to specify the name
@@ -966,8 +2191,15 @@ class RegexSpecifiedAttachments(BasicAttachments):
     The option to add a new column to the sheet specifically for the attachment
     also exists using specify_new_column."""
 
-    def __init__(self, keys, attachments_dir):
-        super().__init__(keys, attachments_dir)
+    def __init__(
+        self,
+        keys,
+        attachments_dir,
+        manifest_location=None,
+        workers=scan.DEFAULT_WORKERS,
+        archives=(),
+    ):
+        super().__init__(keys, attachments_dir, manifest_location, workers, archives)
         self.nonlist_columns = []
         self.list_columns = []
 
@@ -986,10 +2218,9 @@ class RegexSpecifiedAttachments(BasicAttachments):
     def specify_by_regex(self, regex, name, rank=None):
         """Matches the REGEX against the filename, and then updates the display
         name to NAME, and the rank to RANK (default of None, or last) if it matches."""
-        for attachment in self.attachments:
-            if re.search(regex, attachment.file, flags=re.I):
-                attachment.name = name
-                attachment.rank = rank
+        rules = AttachmentRules()
+        rules.specify_by_regex(regex, name, rank)
+        self.apply_rules(rules)
 
     def specify_new_column(self, regex, column_name, rank=None, is_list=False):
         """Matches the REGEX against the filename, and then updates the display
@@ -997,45 +2228,54 @@ class RegexSpecifiedAttachments(BasicAttachments):
 
         Also adds COLUMN_NAME as a a column to the spreadsheet and links the
         attachments specified to that column"""
+        rules = AttachmentRules()
+        rules.specify_new_column(regex, column_name, rank, is_list)
+        self.apply_rules(rules)
+
+    def apply_rules(self, rules):
+        """Applies RULES, an AttachmentRules, to the attachments, in one pass
+        over them.  This is the same as calling specify_by_regex and
+        specify_new_column for each of the rules, in order.  The patterns of
+        the rules that matched an attachment are added to its rules."""
+        for pattern, name, rank, column_name, is_list in rules.rules:
+            if column_name is None:
+                continue
+            if is_list:
+                self.list_columns.append(column_name)
+            else:
+                self.nonlist_columns.append(column_name)
 
-        if is_list:
-            self.list_columns.append(column_name)
-        else:
-            self.nonlist_columns.append(column_name)
+        changed_keys = set()
         for attachment in self.attachments:
-            if re.search(regex, attachment.file, flags=re.I):
+            for pattern, name, rank, column_name, is_list in rules.matching_rules(
+                attachment.file
+            ):
+                if name is not None:
+                    attachment.name = name
                 attachment.rank = rank
-                attachment.column_name = column_name
+                if column_name is not None:
+                    attachment.column_name = column_name
+                attachment.rules.append(pattern)
+                changed_keys.add(attachment.key)
+        self.sort_attachments(changed_keys)
 
 
-class AdminReview(InformationAdder, ProposalFilter):
+class AdminReview(SideSheetAdder):
     """Adds the result of the Admin Review spreadsheets into a column "Valid",
     and is also a filter for proposals that don't show up in that spreadsheet."""
 
-    def __init__(self, csv_location, key_column_name, valid_column_name):
+    def __init__(self, csv_location, key_column_name, valid_column_name, pare=None):
         """Builds the dataset from the CSV_LOCATION, using the KEY_COLUMN_NAME
         to link up against the proposal keys, and the VALID_COLUMN_NAME for
-        which column in the admin spreadsheet has the validity column"""
-        csv_reader = csv.reader(
-            open(csv_location, encoding="utf-8"), delimiter=",", quotechar='"'
+        which column in the admin spreadsheet has the validity column.  The
+        rows for proposals that PARE, the competition's pare if passed in,
+        doesn't include are skipped."""
+        super().__init__(
+            join.SideSheet(
+                csv_location, key_column_name, [valid_column_name], pare=pare
+            ),
+            {"Valid": valid_column_name},
         )
-        header_row = next(csv_reader)
-
-        key_col_idx = header_row.index(key_column_name)
-        valid_col_idx = header_row.index(valid_column_name)
-        self.data = {row[key_col_idx]: row[valid_col_idx] for row in csv_reader}
-
-    def column_type(self, column_name):
-        return None
-
-    def column_names(self):
-        return ["Valid"]
-
-    def cell(self, proposal, column_name):
-        return self.data[proposal.key()] if (proposal.key() in self.data) else ""
-
-    def filter_proposal(self, proposal):
-        return proposal.key() not in self.data
 
 
 class EvaluationRankingsAdder(InformationAdder):
@@ -1054,10 +2294,12 @@ class EvaluationRankingsAdder(InformationAdder):
         overall_rank_col_name,
         score_total_col_name,
         trait_defs,
+        pare=None,
     ):
         """Takes a CSV_LOCATION, reading the data about proposal based on
         APP_COL_NAME, and associating with the data in OVERALL_RANK_COL_NAME,
-        and SOCRE_TOTAL_NAME.
+        and SOCRE_TOTAL_NAME.  The rows for proposals that PARE, the
+        competition's pare if passed in, doesn't include are skipped.
 
         The NAME represents the type of evaluation data (Judge, Peer Review, etc).
 
@@ -1068,41 +2310,31 @@ class EvaluationRankingsAdder(InformationAdder):
           SOURCE_COL_NAME: string, representing the column name in the source spreadsheet
         }"""
 
-        csv_reader = csv.reader(
-            open(csv_location, encoding="utf-8"), delimiter=",", quotechar='"'
-        )
-
         self.name = name
-        self.traits = []
+        self.traits = [trait_def["name"] for trait_def in trait_defs]
         self.evaluation_data = {}
 
-        header_row = next(csv_reader)
-
-        app_col = header_row.index(app_col_name)
-        overall_rank_col = header_row.index(overall_rank_col_name)
-        score_total_col = header_row.index(score_total_col_name)
-
-        for trait_def in trait_defs:
-            self.traits.append(trait_def["name"])
-            trait_def["col"] = header_row.index(trait_def["source_col_name"])
-
-        for row in csv_reader:
-            application_id = row[app_col]
+        side_sheet = join.SideSheet(
+            csv_location,
+            app_col_name,
+            [overall_rank_col_name, score_total_col_name]
+            + [trait_def["source_col_name"] for trait_def in trait_defs],
+            pare=pare,
+        )
 
+        for application_id, row in side_sheet.rows.items():
             evaluation_datum = {
-                "{} Overall Score Rank Normalized".format(self.name): row[
-                    overall_rank_col
-                ],
-                "{} Sum of Scores Normalized".format(self.name): row[score_total_col],
+                "{} Overall Score Rank Normalized".format(self.name): row[0],
+                "{} Sum of Scores Normalized".format(self.name): row[1],
             }
 
-            for trait_def in trait_defs:
+            for trait_def, trait_score in zip(trait_defs, row[2:]):
                 evaluation_datum[
                     "{} {}".format(self.name, trait_def["name"])
                 ] = trait_def["name"]
                 evaluation_datum[
                     "{} {} Score Normalized".format(self.name, trait_def["name"])
-                ] = row[trait_def["col"]]
+                ] = trait_score
 
             self.evaluation_data[application_id] = evaluation_datum
 
@@ -1119,18 +2351,35 @@ class EvaluationRankingsAdder(InformationAdder):
         return names
 
     def cell(self, proposal, column_name):
-        if proposal.key() not in self.evaluation_data:
+        return self.evaluation_cell(
+            self.evaluation_data.get(proposal.key()), column_name
+        )
+
+    def cells(self, proposal, column_names):
+        evaluation_datum = self.evaluation_data.get(proposal.key())
+        return {
+            column_name: self.evaluation_cell(evaluation_datum, column_name)
+            for column_name in column_names
+        }
+
+    def evaluation_cell(self, evaluation_datum, column_name):
+        """Returns the cell for COLUMN_NAME from EVALUATION_DATUM, the
+        evaluation data for a proposal, or None if it doesn't have any"""
+        if evaluation_datum is None:
             if column_name == "%s Overall Score Rank Normalized" % self.name:
                 return "9999"
             return ""
 
-        val = self.evaluation_data[proposal.key()][column_name]
+        val = evaluation_datum[column_name]
 
         if isinstance(val, float):
             return "{0:.1f}".format(val)
         else:
             return val
 
+    def fingerprint(self, proposal):
+        return self.evaluation_data.get(proposal.key(), {})
+
 
 class EvaluationAdder(InformationAdder):
     """Reperesents the evaluation data that comes in from a many to one relationship
@@ -1145,36 +2394,42 @@ class EvaluationAdder(InformationAdder):
         trait_col_name,
         score_normalized_col_name,
         comments_col_name,
-        comments_score_normalized_col_name
+        comments_score_normalized_col_name,
+        pare=None
     ):
         """Takes a NAME representing the name of this evaluation data (Judge, Peer Review, etc)
-        and CSV_READER representing evaluation data in a spreadsheet and turns that into a dict
-        of dicts in the following form:
-
-          EVALUATION_DATA[app_id] = {
-            overall_score_rank_normalized: string,
-            sum_of_scores_normalized: string,
-            traits: array of TRAIT (below)
-          }
-
-          TRAIT = {
-            name: string,
-            score_normalized: string
-            comments: concatenated string, ready for list type
-            comment_scores: concatenated string, ready for list type
-          }
-
-        The columns that data is looked up are required named integer arguments as follows:
-          - APP_COL: column with application number
-          - SCORE_RANK_NORMALIZED_COL: column with normalized score rank
-          - SUM_OF_SCORES_NORMALIZED_COL: column with normalized scores
-          - TRAIT_COL: column with the trait name
-          - SCORE_NORMALIZED_COL: column with the normalized score
-          - COMMENTS_COL: column with the comments
-          - COMMENTS_SCORE_NORMALIZED_COL: the normalized score of the commeng
-
-        The scores for the traits are added up based here rather than in the
-        spreasheet.  Then, comments are concatenated for that trait.
+        and CSV_LOCATION of a spreadsheet with the evaluation data, and groups its rows by
+        application and trait, in one pass, into a dict of the following form:
+
+          EVALUATION_DATA[app_id] = [
+            overall_score_rank_normalized: string, from the first row
+            sum_of_scores_normalized: string, from the first row
+            traits: dict of trait name to TRAIT (below)
+          ]
+
+          TRAIT = [
+            score_normalized: float, the sum of the scores
+            comments: list of the comments, as they are in the spreadsheet
+            comment_scores: list of the normalized comment scores
+          ]
+
+        The columns that data is looked up are required named arguments as follows:
+          - APP_COL_NAME: column with application number
+          - SCORE_RANK_NORMALIZED_COL_NAME: column with normalized score rank
+          - SUM_OF_SCORES_NORMALIZED_COL_NAME: column with normalized scores
+          - TRAIT_COL_NAME: column with the trait name
+          - SCORE_NORMALIZED_COL_NAME: column with the normalized score
+          - COMMENTS_COL_NAME: column with the comments
+          - COMMENTS_SCORE_NORMALIZED_COL_NAME: the normalized score of the comment
+
+        PARE, when passed in, is the competition's pare, and the rows for the
+        applications it doesn't include are only read for their trait, so
+        that a pared run has the same columns as a full one.
+
+        The scores for the traits are added up here rather than in the
+        spreasheet.  The comments for a trait are cleaned up and joined when
+        its cell is asked for, so that's only done once, and not at all for
+        proposals that get filtered out.
 
         The following columns are added:
           - <NAME> Overall Score Rank Normalized
@@ -1190,64 +2445,29 @@ class EvaluationAdder(InformationAdder):
         self.name = params[1]
         csv_location = params[2]
 
-        csv_reader = csv.reader(
-            open(csv_location, encoding="utf-8"), delimiter=",", quotechar='"'
-        )
-
-        self.traits = []
-        self.evaluation_data = {}
-
-        header_row = next(csv_reader)
-
-        app_col = header_row.index(app_col_name)
-        score_rank_normalized_col = header_row.index(score_rank_normalized_col_name)
-        sum_of_scores_normalized_col = header_row.index(
-            sum_of_scores_normalized_col_name
-        )
-        trait_col = header_row.index(trait_col_name)
-        score_normalized_col = header_row.index(score_normalized_col_name)
-        comments_col = header_row.index(comments_col_name)
-        comments_score_normalized_col = header_row.index(
-            comments_score_normalized_col_name
-        )
-
-        for row in csv_reader:
-            application_id = row[app_col]
-            if not application_id in self.evaluation_data:
-                self.evaluation_data[application_id] = {
-                    "%s Overall Score Rank Normalized"
-                    % self.name: row[score_rank_normalized_col],
-                    "%s Sum of Scores Normalized"
-                    % self.name: row[sum_of_scores_normalized_col],
-                }
-
-            evaluation_datum = self.evaluation_data[application_id]
-
-            trait_name = row[trait_col].strip()
-            if trait_name not in self.traits:
-                self.traits.append(trait_name)
-
-            if "%s %s" % (self.name, trait_name) not in evaluation_datum:
-                evaluation_datum["%s %s" % (self.name, trait_name)] = trait_name
-                evaluation_datum[
-                    "%s %s Score Normalized" % (self.name, trait_name)
-                ] = 0.0
-                evaluation_datum["%s %s Comments" % (self.name, trait_name)] = ""
-                evaluation_datum[
-                    "%s %s Comment Scores Normalized" % (self.name, trait_name)
-                ] = ""
-
-            evaluation_datum[
-                "%s %s Score Normalized" % (self.name, trait_name)
-            ] += float(row[score_normalized_col])
-            evaluation_datum["%s %s Comments" % (self.name, trait_name)] += (
-                utils.fix_cell(row[comments_col].replace("\n", "")) + "\n"
-            )
-            evaluation_datum[
-                "%s %s Comment Scores Normalized" % (self.name, trait_name)
-            ] += (row[comments_score_normalized_col] + "\n")
-
-        self.traits.sort()
+        self.traits = set()
+        self.pare = pare
+        evaluation_data = join.SideSheet(
+            csv_location,
+            app_col_name,
+            [
+                app_col_name,
+                score_rank_normalized_col_name,
+                sum_of_scores_normalized_col_name,
+                trait_col_name,
+                score_normalized_col_name,
+                comments_col_name,
+                comments_score_normalized_col_name,
+            ],
+            mode=join.AGGREGATE,
+            aggregate=self.add_evaluation,
+        ).rows
+        self.evaluation_data = {
+            application_id: evaluation
+            for (application_id, evaluation) in evaluation_data.items()
+            if evaluation is not None
+        }
+        self.traits = sorted(self.traits)
 
         self.regular_columns = [
             "%s Overall Score Rank Normalized" % self.name,
@@ -1270,6 +2490,54 @@ class EvaluationAdder(InformationAdder):
             ]
         )
 
+        # What each column is, so that cell doesn't have to pick the column
+        # names apart: the part of the evaluation, and the trait if any
+        self.column_parts = {
+            self.regular_columns[0]: ("Overall Score Rank Normalized", None),
+            self.regular_columns[1]: ("Sum of Scores Normalized", None),
+        }
+        for trait in self.traits:
+            self.column_parts["%s %s" % (self.name, trait)] = ("Trait", trait)
+            for part in ["Score Normalized", "Comments", "Comment Scores Normalized"]:
+                self.column_parts["%s %s %s" % (self.name, trait, part)] = (
+                    part,
+                    trait,
+                )
+
+    def add_evaluation(self, evaluation, evaluation_row):
+        """Adds EVALUATION_ROW, the columns passed to __init__ from a row of
+        the spreadsheet, to EVALUATION, the one for the same application
+        from the rows before it (None for the first one), and returns it.
+        Applications that the pare doesn't include only have their traits
+        noted, and stay None."""
+        (
+            application_id,
+            score_rank_normalized,
+            sum_of_scores_normalized,
+            trait_name,
+            score_normalized,
+            comment,
+            comment_score_normalized,
+        ) = evaluation_row
+
+        trait_name = trait_name.strip()
+        self.traits.add(trait_name)
+        if self.pare is not None and not self.pare.includes(application_id):
+            return None
+
+        if evaluation is None:
+            evaluation = [score_rank_normalized, sum_of_scores_normalized, {}]
+
+        traits = evaluation[2]
+        if trait_name not in traits:
+            traits[trait_name] = [0.0, [], []]
+
+        trait = traits[trait_name]
+        trait[0] += float(score_normalized)
+        trait[1].append(comment)
+        trait[2].append(comment_score_normalized)
+        return evaluation
+
     def column_type(self, column_name):
         if column_name in self.list_columns:
             return "list"
@@ -1279,14 +2547,46 @@ class EvaluationAdder(InformationAdder):
         return self.regular_columns + self.list_columns
 
     def cell(self, proposal, column_name):
-        if proposal.key() not in self.evaluation_data:
+        return self.evaluation_cell(
+            self.evaluation_data.get(proposal.key()), column_name
+        )
+
+    def cells(self, proposal, column_names):
+        evaluation = self.evaluation_data.get(proposal.key())
+        return {
+            column_name: self.evaluation_cell(evaluation, column_name)
+            for column_name in column_names
+        }
+
+    def evaluation_cell(self, evaluation, column_name):
+        """Returns the cell for COLUMN_NAME from EVALUATION, as described in
+        __init__, or None if the proposal doesn't have one"""
+        if evaluation is None:
             if column_name == "%s Overall Score Rank Normalized" % self.name:
                 return "9999"
             return ""
 
-        val = self.evaluation_data[proposal.key()][column_name]
+        part, trait_name = self.column_parts[column_name]
+        if part == "Overall Score Rank Normalized":
+            return evaluation[0].strip()
+        if part == "Sum of Scores Normalized":
+            return evaluation[1].strip()
 
-        if isinstance(val, float):
-            return "{0:.1f}".format(val)
-        else:
-            return val.strip()
+        # Not every application was necessarily evaluated on every trait
+        if trait_name not in evaluation[2]:
+            return ""
+
+        trait = evaluation[2][trait_name]
+        score_normalized, comments, comment_scores_normalized = trait
+        if part == "Trait":
+            return trait_name
+        if part == "Score Normalized":
+            return "{0:.1f}".format(score_normalized)
+        if part == "Comments":
+            return "\n".join(
+                utils.fix_cell(comment.replace("\n", "")) for comment in comments
+            ).strip()
+        return "\n".join(comment_scores_normalized).strip()
+
+    def fingerprint(self, proposal):
+        return self.evaluation_data.get(proposal.key(), [])
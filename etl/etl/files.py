@@ -0,0 +1,139 @@
+# Reading a file per proposal, like the financial sheets that some
+# competitions get as one csv per application.
+#
+# Adders used to read and parse every one of those files as soon as they
+# were made, including the ones for proposals that had been pared or
+# filtered out.  A KeyedFiles knows where the file for each key is, but
+# only parses it when it's first asked for, or ahead of time with load,
+# for the keys that are still in the competition, across a pool of
+# processes.  It can also keep what it parsed in a cache, so that files
+# that haven't changed since the last run don't need parsing again.
+
+import hashlib
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+
+def parse_file(parse, location):
+    """Returns the cache entry for the file at LOCATION, parsed by PARSE:
+    (size, modification time, sha256, what PARSE returned)"""
+    stat = os.stat(location)
+    return (stat.st_size, stat.st_mtime_ns, file_hash(location), parse(location))
+
+
+def file_hash(location):
+    """Returns the sha256 of the contents of the file at LOCATION"""
+    with open(location, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class KeyedFiles:
+    """The files at LOCATIONS, a dict of key to location, parsed by PARSE,
+    which takes the location of a file and returns what's in it.  To be run
+    in a pool of processes, PARSE needs to be picklable, so a module level
+    function or an instance of a module level class.
+
+    If CACHE_LOCATION is passed in, what's parsed is kept in a pickle
+    there, and a file is only parsed again if its contents have changed,
+    which is only checked when its size or modification time have.  VERSION
+    is the version of PARSE, and if it's different from the one the cache
+    was written with, nothing in the cache is used."""
+
+    def __init__(self, locations, parse, cache_location=None, version=""):
+        self.locations = locations
+        self.parse = parse
+        self.cache_location = cache_location
+        self.version = version
+        self.parsed = {}
+        self.cache = {}
+        self.cache_changed = False
+
+        if cache_location is not None and os.path.exists(cache_location):
+            with open(cache_location, "rb") as f:
+                cache = pickle.load(f)
+            if cache["version"] == version:
+                self.cache = cache["files"]
+
+    def __contains__(self, key):
+        return key in self.locations
+
+    def get(self, key, default=None):
+        """Returns the parsed file for KEY, parsing it if it hasn't been
+        yet, and saving the cache, or DEFAULT if there's no file for KEY.
+        As the whole cache is written each time, use load for parsing
+        many files."""
+        if key not in self.locations:
+            return default
+        if key not in self.parsed:
+            self.parse_keys([key], 1)
+            self.save()
+        return self.parsed[key]
+
+    def load(self, keys, workers=1):
+        """Parses the files for KEYS that haven't been yet, with a pool of
+        WORKERS processes if it's more than 1, and then saves the cache"""
+        self.parse_keys(keys, workers)
+        self.save()
+
+    def parse_keys(self, keys, workers):
+        """Parses the files for KEYS that haven't been yet, using the cache
+        for the ones that haven't changed"""
+        locations = []
+        for key in keys:
+            if key in self.parsed or key not in self.locations:
+                continue
+            entry = self.cached_entry(self.locations[key])
+            if entry is None:
+                locations.append((key, self.locations[key]))
+            else:
+                self.parsed[key] = entry[3]
+
+        if workers > 1 and len(locations) > 1:
+            with ProcessPoolExecutor(workers) as executor:
+                entries = list(
+                    executor.map(
+                        parse_file,
+                        [self.parse] * len(locations),
+                        [location for (key, location) in locations],
+                    )
+                )
+        else:
+            entries = [
+                parse_file(self.parse, location) for (key, location) in locations
+            ]
+
+        for (key, location), entry in zip(locations, entries):
+            self.parsed[key] = entry[3]
+            if self.cache_location is not None:
+                self.cache[location] = entry
+                self.cache_changed = True
+
+    def cached_entry(self, location):
+        """Returns the cache entry for LOCATION, if the file there hasn't
+        changed since, or None"""
+        entry = self.cache.get(location)
+        if entry is None:
+            return None
+
+        stat = os.stat(location)
+        if entry[0:2] == (stat.st_size, stat.st_mtime_ns):
+            return entry
+
+        # The file was touched, but it can still have the same contents
+        if entry[2] != file_hash(location):
+            return None
+        entry = (stat.st_size, stat.st_mtime_ns) + entry[2:]
+        self.cache[location] = entry
+        self.cache_changed = True
+        return entry
+
+    def save(self):
+        """Writes the cache, if there is one and it's changed"""
+        if self.cache_location is None or not self.cache_changed:
+            return
+
+        with open(self.cache_location + ".tmp", "wb") as f:
+            pickle.dump({"version": self.version, "files": self.cache}, f)
+        os.replace(self.cache_location + ".tmp", self.cache_location)
+        self.cache_changed = False
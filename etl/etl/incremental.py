@@ -0,0 +1,134 @@
+# Support for only redoing the parts of a competition that changed since the
+# last run.
+#
+# Most runs after the first are to pick up a handful of corrections (a new
+# correction csv, an updated admin review), but every run used to push every
+# proposal through every adder and processor.  An IncrementalState keeps,
+# for every proposal, a hash for each step of the pipeline (each
+# add_supplemental_information or process_cells_special call), along with
+# the cells that step produced and what the adder or processor reported
+# about the proposal (like how many cells fix_cell changed).  The hash of a step covers the hash of the
+# step before it (starting from the raw row and the pipeline version), what
+# the step is, and the step's fingerprint for that proposal, which is
+# whatever the adder or processor uses other than the proposal's own cells,
+# like the proposal's rows in a side sheet.
+#
+# On the next run, a step whose hash for a proposal is the same as last time
+# gives the proposal last time's cells rather than running the adder or
+# processor, and the adder or processor is given last time's report.  A step
+# that doesn't know its fingerprint (the fingerprint method returns None) is
+# run, which is printed once for the step, and its hash covers the cells it
+# produced instead, so the steps after it can still be reused.
+#
+# The state is stored next to etl-processed.csv, by tdc.ProcessedSpreadsheet.
+
+import glob
+import hashlib
+import os
+import pickle
+
+
+def digest(*values):
+    """Returns the hash of VALUES, which need to have a stable repr (strings,
+    numbers, None, and lists, tuples and dicts of those)"""
+    return hashlib.sha256(repr(values).encode("utf-8")).hexdigest()
+
+
+def pipeline_version(*locations):
+    """Returns a version for the pipeline made of the files at LOCATIONS
+    (usually the compose-and-upload script, via __file__) and the etl
+    package itself, which changes whenever any of them do"""
+    locations = list(locations) + sorted(
+        glob.glob(os.path.join(os.path.dirname(__file__), "*.py"))
+    )
+    sources = []
+    for location in locations:
+        with open(location, "rb") as f:
+            sources.append(hashlib.sha256(f.read()).hexdigest())
+    return digest(*sources)
+
+
+class IncrementalState:
+    """The per proposal, per step hashes and cells for a competition, along
+    with those from the last run, read from CONFIG_DIR.  VERSION is the
+    version of the pipeline (see pipeline_version), and if it's different
+    from the last run's, nothing from the last run is reused."""
+
+    state_file_name = "etl-processed-state.pickle"
+
+    def __init__(self, config_dir, version):
+        self.version = version
+        self.previous = {}
+        self.hashes = {}
+        self.steps = {}
+        self.pending_hashes = {}
+        self.unfingerprinted = set()
+        self.reused = 0
+        self.computed = 0
+
+        location = os.path.join(config_dir, self.state_file_name)
+        if os.path.exists(location):
+            with open(location, "rb") as f:
+                state = pickle.load(f)
+            if state["version"] == version:
+                self.previous = state["proposals"]
+
+    def add_proposal(self, key, column_names, row):
+        """Starts the hashes for the proposal with KEY, from its ROW ordered
+        by COLUMN_NAMES"""
+        self.hashes[key] = digest(self.version, column_names, row)
+        self.steps[key] = []
+
+    def previous_cells(self, key, description, fingerprint):
+        """Returns the cells and the report from the last run for the next
+        step of the proposal with KEY, described by DESCRIPTION (which needs
+        to be the same between runs), if its hash with FINGERPRINT is the
+        same as last time.  Otherwise returns None, and the cells need to be
+        computed and passed to record_cells."""
+        if fingerprint is None:
+            if description not in self.unfingerprinted:
+                self.unfingerprinted.add(description)
+                print(
+                    "Not reusing the last run for %s, as it has no fingerprint"
+                    % description
+                )
+            return None
+
+        step = len(self.steps[key])
+        step_hash = digest(self.hashes[key], description, "fingerprint", fingerprint)
+        previous_steps = self.previous.get(key, [])
+        if step < len(previous_steps) and previous_steps[step][0] == step_hash:
+            step_hash, cells, report = previous_steps[step]
+            self.hashes[key] = step_hash
+            self.steps[key].append((step_hash, cells, report))
+            self.reused += 1
+            return (cells, report)
+
+        self.pending_hashes[key] = step_hash
+        return None
+
+    def record_cells(self, key, description, cells, report=None):
+        """Records CELLS as what the step described by DESCRIPTION computed
+        for the proposal with KEY, and REPORT as what the adder or processor
+        reported about it"""
+        step_hash = self.pending_hashes.pop(key, None)
+        if step_hash is None:
+            step_hash = digest(self.hashes[key], description, "cells", cells)
+        self.hashes[key] = step_hash
+        self.steps[key].append((step_hash, cells, report))
+        self.computed += 1
+
+    def save(self, config_dir, keys):
+        """Writes the state for the proposals with KEYS to CONFIG_DIR, for
+        the next run"""
+        state = {
+            "version": self.version,
+            "proposals": {key: self.steps[key] for key in keys},
+        }
+        with open(os.path.join(config_dir, self.state_file_name), "wb") as f:
+            pickle.dump(state, f)
+
+        print(
+            "%s written to TDC config dir (%d steps reused from the last run, %d computed)"
+            % (self.state_file_name, self.reused, self.computed)
+        )
@@ -0,0 +1,122 @@
+# Joining side sheets onto the proposals in a competition.
+#
+# A lot of what goes into a competition comes from csvs other than the
+# proposals csv (admin reviews, corrections, evaluations, extra data
+# that came in later), which have rows keyed by the proposal key.  A
+# SideSheet reads one of those once, keeps only the columns that are
+# needed, and indexes what's left by key, so the adders that use it only
+# have to look the proposal up.  competition.SideSheetAdder adds columns
+# straight from a SideSheet, and the adders in competition that need to
+# do more with the rows use SideSheets to load them.
+
+import csv
+import operator
+
+# How the rows with the same key are joined, see SideSheet
+ONE_TO_ONE = "one to one"
+MANY_TO_ONE = "many to one"
+AGGREGATE = "aggregate"
+
+
+class SideSheet:
+    """A csv at CSV_LOCATION with rows that go with proposals, indexed by
+    the proposal key in KEY_COLUMN.  Only COLUMNS are kept from each row,
+    as a tuple in the same order, or every column if COLUMNS isn't passed
+    in.  KEY_COLUMN and COLUMNS can be names from the header row or
+    positions in the row.  Rows that are too short are treated as having
+    empty cells at the end.
+
+    MODE is how rows with the same key are joined:
+
+      ONE_TO_ONE: each key has the tuple of the last row with that key
+      MANY_TO_ONE: each key has a list of the tuples of all the rows with
+                   that key, in the order of the sheet
+      AGGREGATE: each key has whatever AGGREGATE(VALUE, ROW) returned for
+                 the last row with that key, where VALUE is what it
+                 returned for the row before (None for the first one),
+                 and ROW is the tuple for the row
+
+    The joined values are in rows, by key.
+
+    PARE, when passed in, is the utils.Pare of the competition (its pare),
+    and the rows for keys that it doesn't include are skipped as the sheet
+    is read."""
+
+    def __init__(
+        self,
+        csv_location,
+        key_column,
+        columns=None,
+        mode=ONE_TO_ONE,
+        aggregate=None,
+        pare=None,
+    ):
+        csv_reader = csv.reader(
+            open(csv_location, encoding="utf-8"), delimiter=",", quotechar='"'
+        )
+        self.header = next(csv_reader)
+        if columns is None:
+            columns = list(range(len(self.header)))
+        self.columns = list(columns)
+        self.column_positions = {
+            column: position for (position, column) in enumerate(self.columns)
+        }
+        self.mode = mode
+        self.rows = {}
+
+        # The offsets are worked out once, and itemgetter pulls them all out
+        # of a row in one go.
+        key_offset = self.offset(key_column)
+        offsets = [self.offset(column) for column in self.columns]
+        row_length = max(offsets + [key_offset]) + 1
+        if len(offsets) == 1:
+            offset = offsets[0]
+            project = lambda row: (row[offset],)
+        elif offsets:
+            project = operator.itemgetter(*offsets)
+        else:
+            project = lambda row: ()
+
+        for row in csv_reader:
+            if len(row) < row_length:
+                row = row + [""] * (row_length - len(row))
+            key = row[key_offset]
+            if pare is not None and not pare.includes(key):
+                continue
+            values = project(row)
+            if mode == ONE_TO_ONE:
+                self.rows[key] = values
+            elif mode == MANY_TO_ONE:
+                if key not in self.rows:
+                    self.rows[key] = []
+                self.rows[key].append(values)
+            elif mode == AGGREGATE:
+                self.rows[key] = aggregate(self.rows.get(key), values)
+
+    def offset(self, column):
+        """Returns the position in a row of COLUMN, a name from the header
+        row or a position"""
+        if isinstance(column, int):
+            return column
+        return self.header.index(column)
+
+    def get(self, key, default=None):
+        """Returns the joined value for KEY, or DEFAULT if the sheet doesn't
+        have it"""
+        return self.rows.get(key, default)
+
+    def cell(self, key, column, default=""):
+        """Returns the cell in COLUMN, one of the columns kept, for KEY in a
+        ONE_TO_ONE sheet, or DEFAULT if the sheet doesn't have KEY"""
+        if key not in self.rows:
+            return default
+        return self.rows[key][self.column_positions[column]]
+
+    def __contains__(self, key):
+        return key in self.rows
+
+
+def read_header(csv_location):
+    """Returns the header row of the csv at CSV_LOCATION"""
+    with open(csv_location, encoding="utf-8") as f:
+        return next(csv.reader(f, delimiter=",", quotechar='"'))
@@ -0,0 +1,85 @@
+# Streaming multipart/form-data bodies.
+#
+# requests, and so mwclient, builds a multipart upload in memory, from a
+# copy of every file in it, which for a sheet of hundreds of megabytes
+# means holding it once more on top of the csv it was made from.  A
+# MultipartBody is made of the files themselves, and read from them a
+# chunk at a time as it's sent, which requests does with a chunked
+# transfer encoding.  It can also be gzipped on the way, for servers that
+# accept a gzip content encoding on requests (for instance apache with
+# "SetInputFilter DEFLATE"), which MediaWiki itself doesn't know about.
+
+import uuid
+import zlib
+
+CHUNK_SIZE = 1024 * 1024
+
+# Sheets compress nearly as well at the fastest level as at the default,
+# which takes a few times as long, and would hold up the upload
+GZIP_LEVEL = 1
+
+
+class MultipartBody:
+    """A multipart/form-data body of FIELDS, a dict of field name to string,
+    and FILES, a dict of field name to binary file, which are read from
+    where they are now.  If COMPRESS, the body is gzipped.
+
+    It's an iterable of chunks of bytes, to be passed as the data of a
+    request along with headers, and can be iterated over more than once,
+    for when the request is tried again."""
+
+    def __init__(self, fields, files, compress=False):
+        self.fields = fields
+        self.files = files
+        self.compress = compress
+        self.boundary = uuid.uuid4().hex
+        self.positions = {name: f.tell() for (name, f) in files.items()}
+
+    def headers(self):
+        """Returns the headers to send with the body"""
+        headers = {"Content-Type": "multipart/form-data; boundary=" + self.boundary}
+        if self.compress:
+            headers["Content-Encoding"] = "gzip"
+        return headers
+
+    def __iter__(self):
+        if self.compress:
+            return self.gzipped(self.chunks())
+        return self.chunks()
+
+    def chunks(self):
+        for name, value in self.fields.items():
+            yield self.part_header(name) + str(value).encode("utf-8") + b"\r\n"
+
+        for name, f in self.files.items():
+            yield self.part_header(name, name)
+            f.seek(self.positions[name])
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            yield b"\r\n"
+
+        yield ("--%s--\r\n" % self.boundary).encode("utf-8")
+
+    def part_header(self, name, filename=None):
+        """Returns the header of the part for the field NAME, which is a
+        file named FILENAME if it's passed in"""
+        header = '--%s\r\nContent-Disposition: form-data; name="%s"' % (
+            self.boundary,
+            name,
+        )
+        if filename is not None:
+            header += '; filename="%s"\r\nContent-Type: application/octet-stream' % (
+                filename
+            )
+        return (header + "\r\n\r\n").encode("utf-8")
+
+    def gzipped(self, chunks):
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
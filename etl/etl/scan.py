@@ -0,0 +1,163 @@
+# Finding the attachments for the proposals in a competition.
+#
+# Attachments are always in a directory structure of
+# <attachments_dir>/<key>/*.  Finding them used to take an isdir and a
+# listdir for every key, and an isdir for every file, on every run, which
+# on a network mount with a lot of attachments was most of the time it
+# took to get started.  scan_attachments uses os.scandir, which gets
+# whether an entry is a directory along with its name, and spreads the
+# directories across a pool of threads.
+#
+# It can also keep a manifest of what it found (the files, with their
+# sizes and modification times, for each key), which later runs use for
+# the keys whose directory hasn't been modified since, rather than
+# listing it again.
+#
+# Attachments can also be read straight out of the ZIP archives they come
+# in, rather than extracting them into the attachments dir first, with an
+# AttachmentArchive.
+
+import concurrent.futures
+import json
+import os
+import zipfile
+
+DEFAULT_WORKERS = 8
+
+
+def scan_attachments(
+    attachments_dir, keys, manifest_location=None, workers=DEFAULT_WORKERS
+):
+    """Returns a list of (key, filename) for the files in the directories
+    for KEYS in ATTACHMENTS_DIR, in the order of KEYS and then the order
+    the directories list them in.  Keys without a directory, and anything
+    in the directories that's a directory itself, are skipped.
+
+    The directories are listed with a pool of WORKERS threads.  If
+    MANIFEST_LOCATION is passed in, the manifest there is used for the
+    directories that haven't been modified since it was written, and then
+    it's updated."""
+    with os.scandir(attachments_dir) as entries:
+        key_dirs = {entry.name: entry for entry in entries if entry.is_dir()}
+    keys = [key for key in keys if key in key_dirs]
+
+    manifest = {}
+    if manifest_location is not None:
+        manifest = read_manifest(manifest_location, attachments_dir)
+
+    def scan_key(key):
+        mtime = key_dirs[key].stat().st_mtime_ns
+        if key in manifest and manifest[key]["mtime"] == mtime:
+            return manifest[key]
+
+        files = []
+        with os.scandir(key_dirs[key].path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    continue
+                if manifest_location is None:
+                    files.append([entry.name, None, None])
+                else:
+                    stat = entry.stat()
+                    files.append([entry.name, stat.st_size, stat.st_mtime_ns])
+        return {"mtime": mtime, "files": files}
+
+    if workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            scanned = list(executor.map(scan_key, keys))
+    else:
+        scanned = [scan_key(key) for key in keys]
+
+    if manifest_location is not None:
+        # Keys that weren't asked for this time, say because of pare, are
+        # kept for the next run.
+        manifest.update(zip(keys, scanned))
+        write_manifest(manifest_location, attachments_dir, manifest)
+
+    return [
+        (key, filename)
+        for (key, scanned_key) in zip(keys, scanned)
+        for (filename, size, mtime) in scanned_key["files"]
+    ]
+
+
+def read_manifest(manifest_location, attachments_dir):
+    """Returns the directories in the manifest at MANIFEST_LOCATION, by key,
+    or an empty dict if there isn't one for ATTACHMENTS_DIR there"""
+    if not os.path.exists(manifest_location):
+        return {}
+
+    with open(manifest_location, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("attachments_dir") != os.path.abspath(attachments_dir):
+        return {}
+    return manifest["directories"]
+
+
+def write_manifest(manifest_location, attachments_dir, directories):
+    """Writes DIRECTORIES, by key, to the manifest at MANIFEST_LOCATION for
+    ATTACHMENTS_DIR"""
+    manifest = {
+        "attachments_dir": os.path.abspath(attachments_dir),
+        "directories": directories,
+    }
+    # Written to the side and moved into place, so that a run that's
+    # interrupted doesn't leave half a manifest behind.
+    with open(manifest_location + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_location + ".tmp", manifest_location)
+
+
+class AttachmentArchive:
+    """A ZIP archive at LOCATION with attachments in it, laid out like the
+    attachments dir, as <key>/<filename> at the top of the archive.  The
+    attachments are found from the archive's central directory, and read
+    from it when they're opened."""
+
+    def __init__(self, location):
+        self.location = location
+        self.zip_file = None
+
+    def __getstate__(self):
+        # The open archive can't be pickled, so copies reopen it
+        state = self.__dict__.copy()
+        state["zip_file"] = None
+        return state
+
+    def open_archive(self):
+        """Opens the archive if it isn't already, and returns it"""
+        if self.zip_file is None:
+            self.zip_file = zipfile.ZipFile(self.location)
+        return self.zip_file
+
+    def scan_attachments(self, keys):
+        """Returns a list of (key, filename, member_name) for the files in
+        the archive for KEYS, in the order of KEYS and then the order they're
+        in the archive.  Like scan_attachments, the key is the directory at
+        the top of the archive, and files in a directory under that are
+        skipped, which is reported."""
+        members_by_key = {key: [] for key in keys}
+        for info in self.open_archive().infolist():
+            if info.is_dir():
+                continue
+            parts = info.filename.split("/")
+            if len(parts) < 2 or parts[0] not in members_by_key:
+                continue
+            if len(parts) > 2:
+                print(
+                    "Skipping %s in %s, which isn't <key>/<filename>"
+                    % (info.filename, self.location)
+                )
+                continue
+            members_by_key[parts[0]].append((parts[1], info.filename))
+
+        return [
+            (key, filename, member_name)
+            for key in members_by_key
+            for (filename, member_name) in members_by_key[key]
+        ]
+
+    def open(self, member_name):
+        """Returns a binary stream of the contents of MEMBER_NAME, as
+        returned by scan_attachments"""
+        return self.open_archive().open(member_name)
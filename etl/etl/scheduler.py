@@ -0,0 +1,221 @@
+# Running writes to a wiki concurrently, without overwhelming it.
+#
+# Every page save, toc upload and attachment upload used to wait for the
+# one before it.  A WriteScheduler runs them on a pool of threads, with
+# each host getting a HostLimiter that bounds how many of its writes are
+# in flight at once and how many start per second (a token bucket).
+#
+# How many writes a host gets at once adapts to how it's doing (AIMD):
+# the limit goes up by one after a limit's worth of writes come back
+# quickly, and is halved when a write is slow, or the wiki answers with a
+# 429 or a 5xx.  mwclient retries 5xx responses itself, so those are
+# seen through its wait_callback (see HostLimiter.overloaded), and 429s
+# are retried here, after waiting as long as the wiki asks.
+#
+# Writes that fail are collected into the list that's passed to run,
+# rather than printed as they happen, so that each session can print its
+# own all at once (see print_failures).
+#
+# The default is one worker, which runs the writes one at a time in the
+# thread that's iterating, like before, with the same limits and retries.
+# Running them concurrently is opted in to by asking for more workers.
+
+import concurrent.futures
+import threading
+import time
+
+import requests
+
+DEFAULT_WORKERS = 1
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_RATE = 10.0
+DEFAULT_TARGET_LATENCY = 10.0
+
+# How many times a write that got a 429 is tried again
+MAX_RETRIES = 5
+
+
+class TokenBucket:
+    """Allows RATE things a second on average, and bursts of up to BURST"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Takes a token, waiting for one if there aren't any"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HostLimiter:
+    """Limits the writes to one host to MAX_CONCURRENCY at once, and RATE
+    a second (see TokenBucket).  The number allowed at once starts at 1
+    and adapts between 1 and MAX_CONCURRENCY (see the top of this file),
+    with writes that take longer than TARGET_LATENCY seconds counted as a
+    sign that the host is struggling."""
+
+    def __init__(self, max_concurrency, rate, target_latency):
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.bucket = TokenBucket(rate, max(1, rate))
+        self.limit = 1.0
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Waits until another write can start"""
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        self.bucket.take()
+
+    def release(self, latency):
+        """Records that a write that took LATENCY seconds finished, or None
+        if it was turned away"""
+        with self.condition:
+            self.in_flight -= 1
+            if latency is None or latency > self.target_latency:
+                self.decrease()
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def overloaded(self, *args):
+        """Records that the host is struggling, for instance with a 5xx,
+        which is called as the wait_callback of the mwclient.Site"""
+        with self.condition:
+            self.decrease()
+
+    def decrease(self):
+        self.limit = max(1.0, self.limit / 2)
+
+
+class WriteScheduler:
+    """Runs writes on a pool of WORKERS threads, or one at a time if
+    there's only one, limited per host by a HostLimiter made with
+    MAX_CONCURRENCY, RATE and TARGET_LATENCY.  One scheduler can be shared
+    by sessions with different wikis."""
+
+    def __init__(
+        self,
+        workers=DEFAULT_WORKERS,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        rate=DEFAULT_RATE,
+        target_latency=DEFAULT_TARGET_LATENCY,
+    ):
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.target_latency = target_latency
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def limiter(self, host):
+        """Returns the HostLimiter for HOST"""
+        with self.lock:
+            if host not in self.limiters:
+                self.limiters[host] = HostLimiter(
+                    self.max_concurrency, self.rate, self.target_latency
+                )
+            return self.limiters[host]
+
+    def run(self, host, writes, failures):
+        """Runs WRITES to HOST, an iterable of (description, function, args)
+        tuples, and yields (description, result) for each one that succeeds,
+        as they finish.  The ones that fail are added to FAILURES, a list,
+        as (description, error).
+
+        WRITES is only read from as there's room for more writes, and
+        results are yielded in the thread that's iterating, so WRITES can
+        be a generator that reads files, and what's done with the results
+        doesn't need to be thread safe."""
+        for description, result, error in self.results(self.limiter(host), writes):
+            if error is None:
+                yield (description, result)
+            else:
+                failures.append((description, error))
+
+    def results(self, limiter, writes):
+        """Yields the (description, result, error) of each of WRITES as they
+        finish (see run_write), running them in this thread if there's only
+        one worker"""
+        if self.workers == 1:
+            for write in writes:
+                yield self.run_write(limiter, *write)
+            return
+
+        writes = iter(writes)
+        pending = set()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            while True:
+                while len(pending) < self.workers * 2:
+                    write = next(writes, None)
+                    if write is None:
+                        break
+                    pending.add(executor.submit(self.run_write, limiter, *write))
+
+                if not pending:
+                    return
+
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    yield future.result()
+
+    def run_write(self, limiter, description, function, args):
+        """Runs FUNCTION with ARGS when LIMITER allows, trying again after
+        429s, and returns (DESCRIPTION, result, error)"""
+        for attempt in range(MAX_RETRIES + 1):
+            limiter.acquire()
+            start = time.monotonic()
+            try:
+                result = function(*args)
+            except requests.exceptions.HTTPError as e:
+                limiter.release(None)
+                if e.response is None or e.response.status_code != 429:
+                    return (description, None, e)
+                if attempt == MAX_RETRIES:
+                    return (description, None, e)
+                time.sleep(retry_after(e.response, attempt))
+                continue
+            except Exception as e:
+                limiter.release(time.monotonic() - start)
+                return (description, None, e)
+
+            limiter.release(time.monotonic() - start)
+            return (description, result, None)
+
+
+def print_failures(failures):
+    """Prints FAILURES, a list of (description, error), if there are any"""
+    if not failures:
+        return
+
+    print("%d writes failed:" % len(failures))
+    for description, error in failures:
+        print("  %s: %s" % (description, error))
+
+
+def retry_after(response, attempt):
+    """Returns how many seconds to wait before trying again after RESPONSE,
+    a 429, on the ATTEMPTth try"""
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return 2**attempt
@@ -0,0 +1,341 @@
+# Alternative storage engines for the proposals in a competition.
+#
+# By default, every competition.Proposal keeps its own dict from column
+# name to cell.  That's simple, but every row pays for a dict that holds
+# a reference to every column name, and on the bigger competitions
+# (hundreds of columns of narrative text, thousands of rows) the dicts
+# end up dominating memory use.
+#
+# The engines here can be handed to competition.Competition as its
+# STORAGE argument.  The Competition then asks the engine to create
+# its proposals, and the objects that come back behave the same as
+# competition.Proposal does, so adders, processors, filters and tocs
+# don't need to know which engine is being used.
+
+import os
+import sqlite3
+import tempfile
+
+
+class ColumnarStorage:
+    """Stores the cells of a competition column by column, with one list per
+    column and an index from proposal key to row number.  The proposals
+    created by this storage are ColumnarProposals, which are only a view
+    into a row.
+
+    Columns that get added after loading (by InformationAdders) start
+    out as None for every row, which matches how a Proposal returns None
+    for a column it doesn't have.  Virtual columns (see
+    competition.InformationAdder.virtual_columns) aren't stored at all, and
+    the competition shares its dict of them through virtual_columns."""
+
+    def __init__(self):
+        self.column_index = {}
+        self.column_data = []
+        self.key_rows = {}
+        self.row_count = 0
+        self.key_column_name = None
+        self.virtual_columns = {}
+
+    def create_proposal(self, column_names, row, key_column_name):
+        """Adds ROW, ordered by COLUMN_NAMES, as a new row in the storage and
+        returns the ColumnarProposal viewing it.  KEY_COLUMN_NAME is used to
+        index the row by its key."""
+        self.key_column_name = key_column_name
+        row_num = self.row_count
+        self.row_count += 1
+        for values in self.column_data:
+            values.append(None)
+
+        # Set these one at a time, rather than appending to each column,
+        # so that duplicated column names in the header behave like they
+        # would in a dict, with the last one winning.
+        for column_name, cell in zip(column_names, row):
+            self.set(row_num, column_name, cell)
+
+        proposal = ColumnarProposal(self, row_num)
+        self.key_rows[proposal.key()] = row_num
+        return proposal
+
+    def get(self, row_num, column_name):
+        """Returns the cell at ROW_NUM for COLUMN_NAME, or None if the column
+        doesn't exist"""
+        column_idx = self.column_index.get(column_name)
+        if column_idx is None:
+            return None
+        return self.column_data[column_idx][row_num]
+
+    def set(self, row_num, column_name, cell):
+        """Sets the cell at ROW_NUM for COLUMN_NAME to CELL, adding the column
+        to the storage if it isn't there yet"""
+        column_idx = self.column_index.get(column_name)
+        if column_idx is None:
+            column_idx = len(self.column_data)
+            self.column_index[column_name] = column_idx
+            self.column_data.append([None] * self.row_count)
+        self.column_data[column_idx][row_num] = cell
+
+    def drop_column(self, column_name):
+        """Drops the cells of COLUMN_NAME, which is becoming a virtual column"""
+        column_idx = self.column_index.pop(column_name, None)
+        if column_idx is None:
+            return
+        del self.column_data[column_idx]
+        self.column_index = {
+            name: idx if idx < column_idx else idx - 1
+            for (name, idx) in self.column_index.items()
+        }
+
+    def row_for_key(self, key):
+        """Returns the row number for the proposal with KEY, or None"""
+        return self.key_rows.get(key)
+
+    def compact(self, proposals):
+        """Drops every row that isn't one of PROPOSALS, which must be
+        ColumnarProposals created by this storage, and repoints those
+        proposals at their new rows.  Used after filtering so that the
+        rows of removed proposals don't stay around.
+
+        Proposals not in PROPOSALS are detached from the storage, and
+        shouldn't be used anymore."""
+        proposals = list(proposals)
+        kept_rows = [proposal.row for proposal in proposals]
+        if len(kept_rows) == self.row_count:
+            return
+
+        # One column at a time, so only one extra column is held at once
+        for column_idx, values in enumerate(self.column_data):
+            self.column_data[column_idx] = [values[row_num] for row_num in kept_rows]
+        self.row_count = len(kept_rows)
+        self.key_rows = {}
+        for row_num, proposal in enumerate(proposals):
+            proposal.row = row_num
+            self.key_rows[proposal.key()] = row_num
+
+
+class ColumnarProposal:
+    """A Proposal that's a view onto a row of a ColumnarStorage.  It has the
+    same interface as competition.Proposal, but holds nothing other than
+    the storage and its row number."""
+
+    __slots__ = ("storage", "row")
+
+    def __init__(self, storage, row):
+        self.storage = storage
+        self.row = row
+
+    def add_cell(self, column_name, cell):
+        """Adds a new value CELL to the place held by COLUMN_NAME"""
+        self.storage.set(self.row, column_name, cell)
+
+    def process_cell_special(self, column_name, processor):
+        """Process a cell noted by COLUMN_NAME from PROCESSOR of type CellProcessor"""
+        self.storage.set(
+            self.row, column_name, processor.process_cell(self, column_name)
+        )
+
+    def cell(self, column_name):
+        """Returns the cell value for COLUMN_NAME"""
+        if column_name in self.storage.virtual_columns:
+            return self.storage.virtual_columns[column_name].cell(self)
+        return self.storage.get(self.row, column_name)
+
+    def key(self):
+        """Returns the key for this Proposal"""
+        return self.storage.get(self.row, self.storage.key_column_name)
+
+    def to_csv(self, column_names):
+        """Transforms this Proposal into an array for output, ordered by
+        COLUMN_NAMES"""
+        return [self.cell(column_name) for column_name in column_names]
+
+
+class SqliteStorage:
+    """Stores the cells of a competition in a sqlite database at LOCATION,
+    rather than in memory, for competitions that are too big to hold
+    comfortably.  Without LOCATION, the database goes in a temporary
+    directory that's removed along with the storage.  The database is only
+    scratch space, and is emptied when the storage is created.
+
+    The cells are in a table with one row per cell, keyed on the row number
+    of the proposal and the number of the column, so adding a column
+    doesn't change the table.  Writes are held in memory until there are
+    BATCH_SIZE of them, and then written in one transaction, so memory use
+    is bounded by BATCH_SIZE and sqlite's page cache, plus the
+    SqliteProposals, which only hold the storage, their row number and
+    their key.
+
+    Cells need to be strings, numbers or None, which is what sqlite can
+    hold."""
+
+    def __init__(self, location=None, batch_size=10000):
+        self.temporary_directory = None
+        if location is None:
+            self.temporary_directory = tempfile.TemporaryDirectory()
+            location = os.path.join(self.temporary_directory.name, "proposals.db")
+
+        self.connection = sqlite3.connect(location)
+        # Nothing needs to survive a crash, so there's no need to pay for
+        # the journal or for syncing.
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.connection.execute("DROP TABLE IF EXISTS cells")
+        # No type for value, so that numbers come back as numbers
+        self.connection.execute(
+            "CREATE TABLE cells (row_num INTEGER, column_num INTEGER, value, "
+            "PRIMARY KEY (row_num, column_num)) WITHOUT ROWID"
+        )
+
+        self.batch_size = batch_size
+        self.pending = {}
+        self.column_index = {}
+        self.next_row = 0
+        self.row_count = 0
+        self.key_column_name = None
+        self.virtual_columns = {}
+
+    def create_proposal(self, column_names, row, key_column_name):
+        """Adds ROW, ordered by COLUMN_NAMES, as a new row in the storage and
+        returns the SqliteProposal for it"""
+        self.key_column_name = key_column_name
+        row_num = self.next_row
+        self.next_row += 1
+        self.row_count += 1
+        key = None
+        for column_name, cell in zip(column_names, row):
+            self.set(row_num, column_name, cell)
+            if column_name == key_column_name:
+                key = cell
+        return SqliteProposal(self, row_num, key)
+
+    def get(self, row_num, column_name):
+        """Returns the cell at ROW_NUM for COLUMN_NAME, or None if there
+        isn't one"""
+        column_num = self.column_index.get(column_name)
+        if column_num is None:
+            return None
+        if (row_num, column_num) in self.pending:
+            return self.pending[(row_num, column_num)]
+
+        result = self.connection.execute(
+            "SELECT value FROM cells WHERE row_num = ? AND column_num = ?",
+            (row_num, column_num),
+        ).fetchone()
+        return None if result is None else result[0]
+
+    def get_row(self, row_num, column_names):
+        """Returns the cells at ROW_NUM for COLUMN_NAMES, with one query"""
+        cells = dict(
+            self.connection.execute(
+                "SELECT column_num, value FROM cells WHERE row_num = ?", (row_num,)
+            )
+        )
+        row = []
+        for column_name in column_names:
+            column_num = self.column_index.get(column_name)
+            if (row_num, column_num) in self.pending:
+                row.append(self.pending[(row_num, column_num)])
+            else:
+                row.append(cells.get(column_num))
+        return row
+
+    def set(self, row_num, column_name, cell):
+        """Sets the cell at ROW_NUM for COLUMN_NAME to CELL, adding the column
+        to the storage if it isn't there yet"""
+        column_num = self.column_index.get(column_name)
+        if column_num is None:
+            column_num = len(self.column_index)
+            self.column_index[column_name] = column_num
+        self.pending[(row_num, column_num)] = cell
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def drop_column(self, column_name):
+        """Deletes the cells of COLUMN_NAME, which is becoming a virtual
+        column.  Its column number is kept, so the others don't change."""
+        column_num = self.column_index.get(column_name)
+        if column_num is None:
+            return
+        self.flush()
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM cells WHERE column_num = ?", (column_num,)
+            )
+
+    def flush(self):
+        """Writes the pending cells to the database"""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO cells VALUES (?, ?, ?)",
+                [
+                    (row_num, column_num, cell)
+                    for ((row_num, column_num), cell) in self.pending.items()
+                ],
+            )
+        self.pending = {}
+
+    def compact(self, proposals):
+        """Deletes every row that isn't one of PROPOSALS, which must be
+        SqliteProposals created by this storage.  Used after filtering so
+        that the rows of removed proposals don't stay around."""
+        proposals = list(proposals)
+        if len(proposals) == self.row_count:
+            return
+
+        self.flush()
+        with self.connection:
+            self.connection.execute(
+                "CREATE TEMP TABLE kept (row_num INTEGER PRIMARY KEY)"
+            )
+            self.connection.executemany(
+                "INSERT INTO kept VALUES (?)",
+                [(proposal.row,) for proposal in proposals],
+            )
+            self.connection.execute(
+                "DELETE FROM cells WHERE row_num NOT IN (SELECT row_num FROM kept)"
+            )
+            self.connection.execute("DROP TABLE kept")
+        self.row_count = len(proposals)
+
+
+class SqliteProposal:
+    """A Proposal that's a row of a SqliteStorage.  It has the same interface
+    as competition.Proposal, but holds nothing other than the storage, its
+    row number, and its key, which is asked for often enough that it's
+    worth not going to the database for."""
+
+    __slots__ = ("storage", "row", "key_cell")
+
+    def __init__(self, storage, row, key_cell):
+        self.storage = storage
+        self.row = row
+        self.key_cell = key_cell
+
+    def add_cell(self, column_name, cell):
+        """Adds a new value CELL to the place held by COLUMN_NAME"""
+        self.storage.set(self.row, column_name, cell)
+        if column_name == self.storage.key_column_name:
+            self.key_cell = cell
+
+    def process_cell_special(self, column_name, processor):
+        """Process a cell noted by COLUMN_NAME from PROCESSOR of type CellProcessor"""
+        self.add_cell(column_name, processor.process_cell(self, column_name))
+
+    def cell(self, column_name):
+        """Returns the cell value for COLUMN_NAME"""
+        if column_name in self.storage.virtual_columns:
+            return self.storage.virtual_columns[column_name].cell(self)
+        return self.storage.get(self.row, column_name)
+
+    def key(self):
+        """Returns the key for this Proposal"""
+        return self.key_cell
+
+    def to_csv(self, column_names):
+        """Transforms this Proposal into an array for output, ordered by
+        COLUMN_NAMES"""
+        row = self.storage.get_row(self.row, column_names)
+        for idx, column_name in enumerate(column_names):
+            if column_name in self.storage.virtual_columns:
+                row[idx] = self.storage.virtual_columns[column_name].cell(self)
+        return row
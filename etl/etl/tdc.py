@@ -13,6 +13,7 @@
 # the uploader for debugging and setup of the wikis.
 
 import os
+import shutil
 import csv
 from etl import competition
 
@@ -80,13 +81,47 @@ class AllColumns:
 
 
 class ProcessedSpreadsheet:
-    """Dumps out the final spreadsheet that gets uploaded to torque on to disk."""
+    """Dumps out the final spreadsheet that gets uploaded to torque on to disk,
+    from the same serialized csv as the upload (see Competition.csv_file).
+    If the competition is incremental, the state for the next run goes
+    next to it.
+
+    The keys in the spreadsheet from the last run, if there is one, are
+    kept as the previous_keys of the competition first, which is how the
+    wiki session knows which pages were for its proposals."""
 
     def __init__(self, competition):
         self.competition = competition
 
     def generate(self, config_dir):
-        with open(os.path.join(config_dir, "etl-processed.csv"), "w") as f:
-            self.competition.to_csv(f)
+        location = os.path.join(config_dir, "etl-processed.csv")
+        if os.path.exists(location):
+            self.competition.previous_keys = processed_keys(
+                location, self.competition.key_column_name
+            )
+
+        with open(location, "wb") as f:
+            shutil.copyfileobj(self.competition.csv_file(), f)
 
         print("etl-processed.csv written to TDC config dir")
+
+        if self.competition.incremental is not None:
+            self.competition.incremental.save(
+                config_dir, self.competition.sorted_proposal_keys
+            )
+
+
+def processed_keys(location, key_column_name):
+    """Returns the set of keys in the spreadsheet written by
+    ProcessedSpreadsheet at LOCATION, or None if it doesn't have
+    KEY_COLUMN_NAME"""
+    with open(location, encoding="utf-8", newline="") as f:
+        reader = csv.reader(f, delimiter=",", quotechar='"')
+        columns = next(reader, [])
+        if key_column_name not in columns:
+            return None
+
+        key_column_idx = columns.index(key_column_name)
+        # The second row is the column types
+        next(reader, None)
+        return {row[key_column_idx] for row in reader if len(row) > key_column_idx}
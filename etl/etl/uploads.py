@@ -0,0 +1,246 @@
+# A record of the attachments that have been uploaded to the wiki.
+#
+# Every run used to upload every attachment, even though almost all of
+# them are the same as the last time.  An UploadManifest keeps, in a
+# sqlite database, the sha256 of what was uploaded to each target (the
+# sheet, object id and attachment name, along with the permissions column
+# it was uploaded with), and an attachment is only uploaded again when
+# its contents or its target change.
+#
+# Hashing an attachment means reading it, so the hashes of the files are
+# also kept by their location, size and modification time (or CRC, for
+# attachments in archives), and files that haven't changed aren't read.
+#
+# Each upload is recorded as soon as it succeeds, so an interrupted run
+# picks up where it left off.  A manifest can be shared between
+# competitions, as the sheet name is part of every target.
+#
+# Attachments are streamed to the wiki rather than read in to memory, so
+# what's recorded is hashed as it's read for the upload (see
+# HashingReader), and an UploadProgress shows how the uploads are going.
+
+import hashlib
+import os
+import sqlite3
+import sys
+import time
+
+# How much of an attachment is read at a time when hashing it
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadManifest:
+    """The uploads that have been done, stored in the sqlite database at
+    LOCATION, which is created if it doesn't exist"""
+
+    def __init__(self, location):
+        self.location = location
+        self.connection = None
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.skipped = 0
+        self.skipped_bytes = 0
+
+    def connect(self):
+        """Opens the database if it isn't already, and returns the
+        connection"""
+        if self.connection is not None:
+            return self.connection
+
+        self.connection = sqlite3.connect(self.location)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files "
+            "(location TEXT PRIMARY KEY, size INTEGER, version INTEGER, sha256 TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS uploads "
+            "(sheet_name TEXT, object_id TEXT, attachment_name TEXT, "
+            "permissions_column TEXT, sha256 TEXT, size INTEGER, "
+            "PRIMARY KEY (sheet_name, object_id, attachment_name))"
+        )
+        self.connection.commit()
+        return self.connection
+
+    def file_version(self, attachment):
+        """Returns the (location, size, version) of ATTACHMENT, which change
+        whenever its contents do"""
+        if attachment.archive is None:
+            stat = os.stat(attachment.path)
+            return (os.path.abspath(attachment.path), stat.st_size, stat.st_mtime_ns)
+
+        info = attachment.archive.open_archive().getinfo(attachment.path)
+        location = "%s:%s" % (
+            os.path.abspath(attachment.archive.location),
+            attachment.path,
+        )
+        return (location, info.file_size, info.CRC)
+
+    def file_hash(self, attachment):
+        """Returns the sha256 and size of the contents of ATTACHMENT, only
+        reading it if it's changed since it was last hashed"""
+        location, size, version = self.file_version(attachment)
+        row = (
+            self.connect()
+            .execute(
+                "SELECT sha256 FROM files WHERE location = ? AND size = ? AND version = ?",
+                (location, size, version),
+            )
+            .fetchone()
+        )
+        if row is not None:
+            return (row[0], size)
+
+        with attachment.open() as attachment_stream:
+            reader = HashingReader(attachment_stream)
+            while reader.read(CHUNK_SIZE):
+                pass
+        self.remember_hash(attachment, reader.sha256())
+        return (reader.sha256(), reader.size)
+
+    def remember_hash(self, attachment, sha256):
+        """Stores SHA256 as the hash of the contents of ATTACHMENT"""
+        self.connect().execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            self.file_version(attachment) + (sha256,),
+        )
+
+    def is_uploaded(self, sheet_name, attachment):
+        """Returns whether ATTACHMENT has already been uploaded to SHEET_NAME
+        as it is now, in which case it's counted as skipped"""
+        row = (
+            self.connect()
+            .execute(
+                "SELECT permissions_column, sha256 FROM uploads "
+                "WHERE sheet_name = ? AND object_id = ? AND attachment_name = ?",
+                (sheet_name, attachment.key, attachment.file),
+            )
+            .fetchone()
+        )
+        if row is None or row[0] != attachment.column_name:
+            return False
+
+        sha256, size = self.file_hash(attachment)
+        if row[1] != sha256:
+            return False
+
+        self.skipped += 1
+        self.skipped_bytes += size
+        return True
+
+    def record_upload(self, sheet_name, attachment, sha256, size):
+        """Records that ATTACHMENT, with contents of SIZE bytes that hash to
+        SHA256, was uploaded to SHEET_NAME"""
+        self.remember_hash(attachment, sha256)
+        self.connect().execute(
+            "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                sheet_name,
+                attachment.key,
+                attachment.file,
+                attachment.column_name,
+                sha256,
+                size,
+            ),
+        )
+        self.connection.commit()
+        self.uploaded += 1
+        self.uploaded_bytes += size
+
+    def report(self):
+        """Prints how many attachments were uploaded and skipped"""
+        # Hashes of files that were checked but didn't need uploading
+        self.connect().commit()
+        print(
+            "%d attachments uploaded (%d bytes), %d unchanged ones skipped (%d bytes saved)"
+            % (self.uploaded, self.uploaded_bytes, self.skipped, self.skipped_bytes)
+        )
+
+
+class HashingReader:
+    """Reads from the binary STREAM, keeping the sha256 and size of what's
+    been read, so that what's uploaded can be recorded without holding it.
+    Seeking starts them over, so it's only for going back to the start, as
+    a request that's tried again does."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.restart()
+
+    def restart(self):
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+    def tell(self):
+        return self.stream.tell()
+
+    def seek(self, position):
+        self.stream.seek(position)
+        self.restart()
+
+    def sha256(self):
+        return self.hash.hexdigest()
+
+
+class UploadProgress:
+    """Shows how far along uploading FILES attachments, of TOTAL_BYTES, is,
+    and how fast it's going, in bytes and files a second.  On a terminal,
+    it's one line that's redrawn as attachments finish, at most every
+    INTERVAL seconds, and otherwise a line is printed every LOG_INTERVAL
+    seconds."""
+
+    def __init__(self, files, total_bytes, interval=0.5, log_interval=10.0):
+        self.files = files
+        self.total_bytes = total_bytes
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.on_terminal = sys.stdout.isatty()
+        self.interval = interval if self.on_terminal else log_interval
+        self.started = time.monotonic()
+        self.shown = self.started
+
+    def record(self, size):
+        """Records that an attachment of SIZE bytes was uploaded"""
+        self.uploaded += 1
+        self.uploaded_bytes += size
+        if time.monotonic() - self.shown >= self.interval:
+            self.show()
+
+    def show(self):
+        self.shown = time.monotonic()
+        elapsed = max(self.shown - self.started, 0.001)
+        line = "Uploaded %d/%d attachments, %s/%s (%s/s, %.1f files/s)" % (
+            self.uploaded,
+            self.files,
+            format_bytes(self.uploaded_bytes),
+            format_bytes(self.total_bytes),
+            format_bytes(self.uploaded_bytes / elapsed),
+            self.uploaded / elapsed,
+        )
+        if self.on_terminal:
+            sys.stdout.write("\r\033[K" + line)
+            sys.stdout.flush()
+        else:
+            print(line)
+
+    def finish(self):
+        """Shows where the uploads ended up"""
+        if self.files == 0:
+            return
+        self.show()
+        if self.on_terminal:
+            print()
+
+
+def format_bytes(size):
+    """Returns SIZE, a number of bytes, with a unit, like 12.3MB"""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return "%.1f%s" % (size, unit)
@@ -1,17 +1,59 @@
+import hashlib
 import re
 import warnings
+import zlib
+from html import unescape as html_unescape
 from math import floor
 from bs4 import BeautifulSoup
 
-# Used in converting "<foo>&nbsp;<bar>" and "</foo>&nbsp;<bar>"
-# to "<foo> <bar>" and "</foo> <bar>" respectively.  (Those particular
-# instances of "&nbsp;" in the data are not very convincing, and they
-# create noise when we're looking for unnecessary escaping elsewhere.)
-intertag_nbsp_re = re.compile("(?m)(</?[a-z]+>)&nbsp;(<[a-z]+>)")
+# The tags that balance_tags knows how to handle without BeautifulSoup.
+# These are the ones we see in the data without attributes.  Anything
+# else (attributes, comments, other tags) goes through BeautifulSoup.
+simple_tags = {
+    "b",
+    "br",
+    "div",
+    "em",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "hr",
+    "i",
+    "li",
+    "ol",
+    "p",
+    "span",
+    "strong",
+    "sub",
+    "sup",
+    "table",
+    "tbody",
+    "td",
+    "th",
+    "thead",
+    "tr",
+    "u",
+    "ul",
+}
+void_tags = {"br", "hr"}
 
-# Matches Unicode 8226 (U+2022) at the beginning of a line,
-# which is something that applicants do in a lot of fields.
-bullets_re = re.compile("^•", re.MULTILINE)
+# How BeautifulSoup's html.parser outputs these entities
+simple_entities = {
+    "amp": "&amp;",
+    "lt": "&lt;",
+    "gt": "&gt;",
+    "nbsp": "\xa0",
+    "quot": '"',
+}
+
+# Matches, in order of the groups, a tag without attributes, one of the
+# simple_entities, or any other markup character
+html_token_re = re.compile(
+    "<(/?)([a-zA-Z][a-zA-Z0-9]*)\\s*(/?)>|&(%s);|[&<>]" % "|".join(simple_entities)
+)
 
 
 def collapse_replace(string, old, new):
@@ -21,6 +63,246 @@ def collapse_replace(string, old, new):
     return string
 
 
+class TextRules:
+    """An ordered table of (PATTERN, REPLACEMENT) rules, compiled into a
+    single regular expression so that applying all of them is one pass
+    over the text.
+
+    At each position in the text, the first rule whose PATTERN matches
+    wins, and the text it matched isn't looked at again.  That means
+    rules that used to feed into each other when run one after another
+    have to be written to match what the combination would have done.
+    REPLACEMENT is either a string, which can refer to the groups in its
+    own PATTERN as "\\1" and so on, or a function that takes the match
+    of PATTERN and returns the replacement.  PATTERNs shouldn't use
+    named groups.
+
+    Each rule is marked with an empty group after its PATTERN, rather than
+    wrapping it, so that rules whose PATTERN starts with a literal
+    character can be skipped cheaply, and if all of them do, the regex
+    only stops at those characters.  So where it doesn't change what
+    matches, start PATTERNs with a literal, with any lookbehind after it.
+
+    Competitions that need more rules can use extend, which returns a new
+    TextRules and leaves this one alone."""
+
+    def __init__(self, rules, flags=0):
+        self.rules = list(rules)
+        self.flags = flags
+        self.regex = re.compile(
+            "|".join(
+                "(?:%s)(?P<rule%d>)" % (pattern, idx)
+                for idx, (pattern, replacement) in enumerate(self.rules)
+            ),
+            flags,
+        )
+
+        # Literal replacements are the common case, and don't need the
+        # rule's own match, so they're looked up by the number of the
+        # rule's group and returned straight from replace
+        self.group_rules = {}
+        self.literals = {}
+        self.rule_regexes = []
+        for idx, (pattern, replacement) in enumerate(self.rules):
+            group = self.regex.groupindex["rule%d" % idx]
+            self.group_rules[group] = idx
+            if isinstance(replacement, str) and "\\" not in replacement:
+                self.literals[group] = replacement
+            self.rule_regexes.append(re.compile(pattern, flags))
+
+    def extend(self, rules):
+        """Returns a new TextRules with RULES after the ones in this one"""
+        return TextRules(self.rules + list(rules), self.flags)
+
+    def replace(self, match):
+        """Returns the replacement for MATCH, a match of the combined regex"""
+        literal = self.literals.get(match.lastindex)
+        if literal is not None:
+            return literal
+
+        idx = self.group_rules[match.lastindex]
+        rule_match = self.rule_regexes[idx].match(match.string, match.start())
+        replacement = self.rules[idx][1]
+        if callable(replacement):
+            return replacement(rule_match)
+        return rule_match.expand(replacement)
+
+    def apply(self, text):
+        """Returns TEXT with all the rules applied"""
+        return self.regex.sub(self.replace, text)
+
+
+# The same limited set of unescapings the original 'sanitize' script did.
+# These go first, in their own pass, because what they produce ("<",
+# "&nbsp;") is what the rest of the rules look for.  The "&amp;lt;" ones
+# are there because these used to be run one after the other, so that
+# "&amp;lt;" ended up as "<".
+unescape_rules = TextRules(
+    [
+        ("&amp;lt;", "<"),
+        ("&amp;gt;", ">"),
+        ("&amp;", "&"),
+        ("&lt;", "<"),
+        ("&gt;", ">"),
+    ]
+)
+
+
+def nbsp_rules(spaces):
+    """Returns the rules for cleaning up "&nbsp;", where SPACES is a regex
+    character class of what counts as a space next to one.
+
+    A run of "&nbsp;"s next to a space, or right before a closing tag,
+    goes away, and any other run becomes a single "&nbsp;".  The
+    exception is "<foo>&nbsp;<bar>" and "</foo>&nbsp;<bar>", which
+    become "<foo> <bar>" and "</foo> <bar>".  (Those particular instances
+    of "&nbsp;" in the data are not very convincing, and they create noise
+    when we're looking for unnecessary escaping elsewhere.)"""
+    return [
+        ("<(/?[a-z]+>)(?:&nbsp;)+(<[a-z]+>)", "<\\1 \\2"),
+        ("&nbsp;(?<=%s&nbsp;)(?:&nbsp;)*" % spaces, ""),
+        ("&nbsp;(?:&nbsp;)*(?=%s|</)" % spaces, ""),
+        ("&nbsp;(?:&nbsp;)+", "&nbsp;"),
+    ]
+
+
+# Backslash escaped quotes, however many backslashes there are
+escaped_quote_rules = [('\\\\\\\\*"', '"')]
+
+# The second pass of fix_cell, after unescape_rules
+fix_cell_rules = TextRules(
+    [("\t", " ")]
+    + nbsp_rules("[ \t]")
+    + escaped_quote_rules
+    + [
+        ("''", '"'),
+        ("\\\\n", "<br/>\n"),
+        ("\n", "<br/>\n"),
+    ]
+)
+
+# Unicode 8226 (U+2022) at the beginning of a line, which is something
+# that applicants do in a lot of fields.  The parsing for lists requires
+# an asterisk at the start of the line instead.
+bullet_rules = TextRules([("^•", "*")], re.MULTILINE)
+
+# The version of what fix_cell does, for caches of its results (see
+# cache.CellCache).  The rule tables are part of it, so changing them
+# makes a new version on its own, but any other change to what fix_cell
+# returns needs the number at the front bumped.
+fix_cell_rules_digest = hashlib.sha256(
+    repr([unescape_rules.rules, fix_cell_rules.rules, bullet_rules.rules]).encode()
+).hexdigest()
+fix_cell_version = "1-" + fix_cell_rules_digest[:16]
+
+# A cell without any of these characters has nothing for fix_cell to do
+# other than strip it
+clean_cell_re = re.compile("[&<>\t\n\\\\'•]")
+
+
+def balance_tags(html):
+    """Return HTML in the same well-formed form that BeautifulSoup's
+    html.parser would give, with dangling tags closed and stray closing
+    tags dropped, but without building a tree.
+
+    Only handles the simple markup that shows up in most cells: the
+    simple_tags without attributes, the simple_entities, and lone
+    ampersands and angle brackets.  Returns None for anything else, so
+    the caller can fall back to BeautifulSoup."""
+    if "<" not in html and ">" not in html and "&" not in html:
+        return collapse_whitespace_text(html)
+
+    output = []
+    text = []
+    open_tags = []
+    pos = 0
+    for match in html_token_re.finditer(html):
+        text.append(html[pos : match.start()])
+        pos = match.end()
+        closing, tag, self_closing, entity = match.groups()
+
+        if tag is None:
+            char = match.group(0)
+            next_char = html[pos : pos + 1]
+            if entity is not None:
+                text.append(simple_entities[entity])
+            elif char == ">":
+                text.append("&gt;")
+            elif char == "&" and not (next_char.isalnum() or next_char == "#"):
+                text.append("&amp;")
+            elif char == "<" and next_char.isspace():
+                text.append("&lt;")
+            else:
+                return None
+            continue
+
+        tag = tag.lower()
+        if tag not in simple_tags or (tag in void_tags and closing):
+            return None
+
+        # Every tag ends the text before it, even ones that are dropped
+        output.append(collapse_whitespace_text("".join(text)))
+        text = []
+
+        if tag in void_tags:
+            output.append("<%s/>" % tag)
+        elif closing:
+            if self_closing:
+                return None
+            # Close everything that was left open inside this tag, and
+            # drop closing tags that were never opened
+            if tag in open_tags:
+                while True:
+                    open_tag = open_tags.pop()
+                    output.append("</%s>" % open_tag)
+                    if open_tag == tag:
+                        break
+        elif self_closing:
+            output.append("<%s></%s>" % (tag, tag))
+        else:
+            open_tags.append(tag)
+            output.append("<%s>" % tag)
+
+    text.append(html[pos:])
+    output.append(collapse_whitespace_text("".join(text)))
+    output.extend("</%s>" % tag for tag in reversed(open_tags))
+    return "".join(output)
+
+
+def collapse_whitespace_text(text):
+    """Return TEXT, a run of text between tags, the way BeautifulSoup
+    stores it, which is to collapse text that's only whitespace down to
+    a newline (if there was one) or a space."""
+    if text and not text.strip(" \n\t\f\r"):
+        return "\n" if "\n" in text else " "
+    return text
+
+
+def text_outside_strong(html):
+    """Return the text of HTML that isn't inside of <strong> tags, the way
+    BeautifulSoup would see it, or None if HTML is more than balance_tags
+    can handle."""
+    balanced = balance_tags(html)
+    if balanced is None:
+        return None
+
+    text = []
+    strong_depth = 0
+    pos = 0
+    for match in html_token_re.finditer(balanced):
+        if strong_depth == 0:
+            text.append(balanced[pos : match.start()])
+        pos = match.end()
+        closing, tag, self_closing, entity = match.groups()
+
+        if tag == "strong":
+            strong_depth += -1 if closing else 1
+        elif entity is not None and strong_depth == 0:
+            text.append(html_unescape(match.group(0)))
+    text.append(balanced[pos:])
+    return "".join(text)
+
+
 def weaken_the_strong(html):
     """Strip any meaningless <strong>...</strong> tags from HTML.
     HTML is a Unicode string; the return value is either HTML or a new
@@ -33,15 +315,18 @@ def weaken_the_strong(html):
     if not "<strong>" in html:
         return html
 
-    # Remove the stuff inside strong tags
-    soup = BeautifulSoup(html, "html.parser")
-    while "<strong>" in str(soup):
-        soup.strong.extract()
+    # Remove the stuff inside strong tags, without BeautifulSoup if we can
+    text = text_outside_strong(html)
+    if text is None:
+        soup = BeautifulSoup(html, "html.parser")
+        while "<strong>" in str(soup):
+            soup.strong.extract()
+        text = soup.get_text()
 
     # Check whether the non-bold stuff is more than just tags and
     # punctuation.  If not, all the important stuff was bold, so strip
     # bold and return.
-    if re.sub(r"\W", "", soup.get_text()) == "":
+    if re.sub(r"\W", "", text) == "":
         return re.sub("</?strong>", "", html)
 
     # OTOH, if the non-bold stuff contained letters or numbers, maybe
@@ -62,39 +347,32 @@ def form_well(html):
     return soup
 
 
-def fix_cell(cell):
+def well_formed(html):
+    """Return HTML as the string of form_well, but using balance_tags when
+    HTML is simple enough for it, which is most of the time."""
+    balanced = balance_tags(html)
+    if balanced is None:
+        balanced = str(form_well(html))
+    return balanced
+
+
+def fix_cell(cell, extra_rules=None):
     """Return a cleaned up version of the CELL that will work well
-    with mediawiki, mainly through text subsitution."""
-    # A straight-up HTML-unescaping might be the right thing
-    # (i.e., cell = html_parser.unescape(cell) below)
-    # in the long run, but for now, let's do the same limited
-    # set of unescapings the original 'sanitize' script did:
-    cell = cell.replace("&amp;", "&")
-    cell = cell.replace("&lt;", "<")
-    cell = cell.replace("&gt;", ">")
-    # The rest should be recursively collapsing replacements:
-    cell = collapse_replace(cell, "\t", " ")
-    cell = collapse_replace(cell, "&nbsp;&nbsp;", "&nbsp;")
-    cell = collapse_replace(cell, "&nbsp; ", " ")
-    cell = collapse_replace(cell, " &nbsp;", " ")
-    cell = collapse_replace(cell, "&nbsp;</", "</")
-    cell = collapse_replace(cell, '\\"', '"')
-    cell = collapse_replace(cell, "''", '"')
-    cell = cell.replace("\\n", "\n")
-    cell = cell.replace("\n", "<br/>\n")
-    cell = re.sub(intertag_nbsp_re, "\\1 \\2", cell)
-
-    soup = form_well(cell)
-    cell = weaken_the_strong(str(soup))
-
-    # The parsing for lists requires an asterisk at the start
-    # of the line, but some entries use bullets. This regex
-    # swaps the bullets for asterisks.
-    cell = bullets_re.sub("*", cell)
-
-    # We don't want to have extra new lines added at the beginning or end
-    # because that could make the wiki formatting odd
-    cell = cell.strip()
+    with mediawiki, mainly through text subsitution.
+
+    EXTRA_RULES, if given, is a TextRules that's applied to the cleaned up
+    cell, for competitions whose data needs more fixing than this."""
+    if clean_cell_re.search(cell) is None:
+        cell = cell.strip()
+    else:
+        cell = unescape_rules.apply(cell)
+        cell = fix_cell_rules.apply(cell)
+        cell = weaken_the_strong(well_formed(cell))
+        cell = bullet_rules.apply(cell)
+
+        # We don't want to have extra new lines added at the beginning or end
+        # because that could make the wiki formatting odd
+        cell = cell.strip()
 
     if cell.lower() == "null":
         cell = ""
@@ -102,6 +380,9 @@ def fix_cell(cell):
     if cell.lower() == "not applicable":
         cell = ""
 
+    if extra_rules is not None:
+        cell = extra_rules.apply(cell)
+
     return cell
 
 
@@ -119,25 +400,79 @@ def commaize_number(number):
 
 def parse_pare(pare_option):
     """Parses the PARE_OPTION and returns a tuple of
-    (PARE_FACTOR, KEYS_TO_INCLUDE) where PARE_FACTOR is an int
-    by which proposals should be reduced, and KEYS_TO_INCLUDE
-    is a list of proposals to include by key.  Exactly one of the
-    two will be a value, with the other being None."""
+    (PARE_FACTOR, KEYS_TO_INCLUDE, SAMPLE_FACTOR) where PARE_FACTOR is an int
+    by which proposals should be reduced, by keeping every PARE_FACTORth row,
+    KEYS_TO_INCLUDE is a set of proposals to include by key, and
+    SAMPLE_FACTOR is an int by which proposals should be reduced, by keeping
+    the ones whose key is in the sample (see in_pare_sample).  At most one
+    of the three will be a value, with the others being None."""
 
     pare_factor = None
     keys_to_include = None
+    sample_factor = None
     if pare_option is None:
         pass
     elif pare_option.startswith("@"):
         with open(pare_option[1:]) as pare_file:
-            keys_to_include = [
+            keys_to_include = {
                 l.strip().split(" ")[0] for l in pare_file.readlines() if l.strip()
-            ]
+            }
     elif pare_option.startswith("+"):
-        keys_to_include = pare_option[1:].split(",")
+        keys_to_include = set(pare_option[1:].split(","))
+    elif pare_option.startswith("%"):
+        try:
+            sample_factor = int(pare_option[1:])
+        except:
+            raise Exception("Pare option not a number: " + pare_option)
     else:
         try:
             pare_factor = int(pare_option)
         except:
             raise Exception("Pare option not a number: " + pare_option)
-    return (pare_factor, keys_to_include)
+    return (pare_factor, keys_to_include, sample_factor)
+
+
+def in_pare_sample(key, sample_factor):
+    """Returns whether KEY is in the 1/SAMPLE_FACTOR sample of keys, which
+    is decided by the key alone, the same way on every run (unlike hash,
+    which changes between runs), so that every sheet agrees on it without
+    having to know the rest of the keys"""
+    return zlib.crc32(key.encode("utf-8")) % sample_factor == 0
+
+
+class Pare:
+    """The proposals that a run is pared down to, from PARE_OPTION (see
+    parse_pare).  Competition makes one out of its PARE, and the loaders
+    of side sheets use it, through includes, to skip the rows for
+    proposals that aren't in the run as they read them.
+
+    Keeping every PARE_FACTORth row can only be decided by the proposals
+    sheet, so once the competition has read it, it narrows the Pare down
+    to the keys it kept."""
+
+    def __init__(self, pare_option):
+        self.pare_factor, self.keys, self.sample_factor = parse_pare(pare_option)
+
+    def includes_row(self, row_num, key):
+        """Returns whether the proposal with KEY, in row ROW_NUM of the
+        proposals sheet (starting at 1), is included"""
+        if self.pare_factor is not None and (row_num % self.pare_factor) != 0:
+            return False
+        return self.includes(key)
+
+    def includes(self, key):
+        """Returns whether the proposal with KEY is included"""
+        if self.keys is not None and key not in self.keys:
+            return False
+        if self.sample_factor is not None and not in_pare_sample(
+            key, self.sample_factor
+        ):
+            return False
+        return True
+
+    def narrow(self, keys):
+        """Includes only KEYS from now on, which have to be ones that were
+        included"""
+        self.pare_factor = None
+        self.sample_factor = None
+        self.keys = set(keys)
@@ -1,29 +1,102 @@
+import contextlib
 import mwclient
 import json
-import io
-from etl import competition
+import re
+import requests
+import threading
+from etl import competition, multipart, scheduler, uploads
+
+# How many titles are asked about in one query, which is the API's limit
+# for users without the apihighlimits right (bots have 500)
+TITLES_PER_QUERY = 50
 
 
 class WikiSession:
     """Represents a session that's logged into a wiki to upload all
     of the information about a competition.  Requires a user, password
     competition name, and a url.  These are usually configured in the
-    etl pipelines in a config.py"""
+    etl pipelines in a config.py
+
+    Pages, tocs and attachments are written by WRITE_SCHEDULER, a
+    scheduler.WriteScheduler, if passed in (to share one between sessions,
+    or to write concurrently with more than one worker), or one of its own
+    that writes them one at a time.  The writes that fail are reported
+    after each step rather than stopping the upload.
 
-    def __init__(self, username, password, competition_name, url):
+    If compress_uploads is set, the sheet is gzipped as it's uploaded,
+    which the wiki's web server has to be set up to accept."""
+
+    def __init__(self, username, password, competition_name, url, write_scheduler=None):
         (scheme, host) = url.split("://")
 
-        # We need a very large timeout because uploading reindexes everything!
-        self.site = mwclient.Site(host, path="/", scheme=scheme, reqs={"timeout": 300})
-        self.site.login(username, password)
+        self.scheme = scheme
+        self.host = host
+        self.username = username
+        self.password = password
+        self.write_scheduler = write_scheduler
+        if write_scheduler is None:
+            self.write_scheduler = scheduler.WriteScheduler()
+        self.failures = []
+
+        self.site = self.connect()
+        self.thread = threading.current_thread()
+        self.idle_sites = []
+        self.idle_sites_lock = threading.Lock()
         self.competition_name = competition_name
         self.csv_only = False
+        self.compress_uploads = False
+
+    def connect(self):
+        """Returns a new mwclient.Site for the wiki, logged in"""
+        # We need a very large timeout because uploading reindexes everything!
+        site = mwclient.Site(
+            self.host,
+            path="/",
+            scheme=self.scheme,
+            reqs={"timeout": 300},
+            wait_callback=self.write_scheduler.limiter(self.host).overloaded,
+        )
+        site.login(self.username, self.password)
+        return site
 
-    def upload_sheet(self, comp):
+    @contextlib.contextmanager
+    def thread_site(self):
+        """Gives a logged in mwclient.Site that only the calling thread is
+        using.  A Site's requests session and cached tokens aren't safe to
+        share between threads, so the write scheduler's worker threads each
+        borrow their own, which are logged in as they're first needed and
+        kept for later writes, and the thread that made the session uses
+        self.site."""
+        if threading.current_thread() is self.thread:
+            yield self.site
+            return
+
+        with self.idle_sites_lock:
+            site = self.idle_sites.pop() if self.idle_sites else None
+        if site is None:
+            site = self.connect()
+        try:
+            yield site
+        finally:
+            with self.idle_sites_lock:
+                self.idle_sites.append(site)
+
+    def run_writes(self, writes):
+        """Runs WRITES with the write scheduler (see
+        scheduler.WriteScheduler.run), yielding the descriptions and results
+        of the ones that succeed, and then reports the ones that failed"""
+        yield from self.write_scheduler.run(self.host, writes, self.failures)
+        self.report()
+
+    def report(self):
+        """Prints the writes that failed since the last report, if any"""
+        scheduler.print_failures(self.failures)
+        self.failures = []
+
+    def upload_sheet(self, comp, extra_pages=None):
         """Uploads the sheet, the tocs, and creates the pages for
-        a Competition COMP"""
-        self.site.raw_call(
-            "api",
+        a Competition COMP, along with EXTRA_PAGES (see create_pages)"""
+        self.post_streaming(
             {
                 "action": "torquedataconnectuploadsheet",
                 "format": "json",
@@ -31,87 +104,308 @@ class WikiSession:
                 "sheet_name": self.competition_name,
                 "key_column": comp.key_column_name,
             },
-            {"data_file": comp.to_csv(io.StringIO()).getvalue()},
+            {"data_file": comp.csv_file()},
+            self.compress_uploads,
         )
 
-        for toc in comp.tocs:
-            self.upload_toc(toc)
+        for description, result in self.run_writes(
+            ("Uploading toc " + toc.name, self.upload_toc, (toc,)) for toc in comp.tocs
+        ):
+            pass
 
         if not self.csv_only:
-            self.create_pages(comp)
+            self.create_pages(comp, extra_pages)
+
+    def post_streaming(self, data, files, compress=False):
+        """Posts DATA to the api, like site.raw_call, along with FILES, a dict
+        of field name to binary file, which are streamed from the files as a
+        multipart.MultipartBody (gzipped if COMPRESS) rather than read in to
+        memory.  Like raw_call, connection errors and 5xx responses are tried
+        again, and the text of the response is returned."""
+        with self.thread_site() as site:
+            url = "%s://%s%sapi%s" % (site.scheme, site.host, site.path, site.ext)
+            body = multipart.MultipartBody(data, files, compress)
+            sleeper = site.sleepers.make()
+            while True:
+                try:
+                    response = site.connection.post(
+                        url, data=body, headers=body.headers(), **site.requests
+                    )
+                except (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                ):
+                    sleeper.sleep()
+                    continue
+
+                if 500 <= response.status_code <= 599:
+                    sleeper.sleep()
+                    continue
+                response.raise_for_status()
+                return response.text
 
-    def upload_attachments(self, attachments):
+    def upload_attachments(self, attachments, upload_manifest=None):
         """Uploads all the ATTACHMENTS, which is a list of
-        competition.Attachment"""
+        competition.Attachment, streaming each one from where it is, and
+        showing the progress (see uploads.UploadProgress).  If
+        UPLOAD_MANIFEST, an uploads.UploadManifest, is passed in, the ones
+        that were already uploaded as they are now are skipped, and the rest
+        are recorded in it as they finish, so that a run that's interrupted
+        picks up where it left off."""
 
         if self.csv_only:
             return
 
-        for attachment in attachments:
-            print("Uploading " + attachment.file)
-            with open(attachment.path, "rb") as attachment_stream:
-                self.site.raw_call(
-                    "api",
-                    {
-                        "action": "torquedataconnectuploadattachment",
-                        "format": "json",
-                        "sheet_name": self.competition_name,
-                        "object_id": attachment.key,
-                        "permissions_column": attachment.column_name,
-                        "attachment_name": attachment.file,
-                    },
-                    {"attachment": attachment_stream.read()},
+        if upload_manifest is not None:
+            attachments = [
+                attachment
+                for attachment in attachments
+                if not upload_manifest.is_uploaded(self.competition_name, attachment)
+            ]
+        progress = uploads.UploadProgress(
+            len(attachments), sum(attachment.size() for attachment in attachments)
+        )
+
+        for description, (attachment, sha256, size) in self.run_writes(
+            ("Uploading " + attachment.file, self.upload_attachment, (attachment,))
+            for attachment in attachments
+        ):
+            if upload_manifest is not None:
+                upload_manifest.record_upload(
+                    self.competition_name, attachment, sha256, size
                 )
+            progress.record(size)
+        progress.finish()
+
+        if upload_manifest is not None:
+            upload_manifest.report()
+
+    def upload_attachment(self, attachment):
+        """Uploads ATTACHMENT, a competition.Attachment, streamed from where
+        it is, and returns it along with the sha256 and size of what was
+        uploaded"""
+        with attachment.open() as attachment_stream:
+            reader = uploads.HashingReader(attachment_stream)
+            self.post_streaming(
+                {
+                    "action": "torquedataconnectuploadattachment",
+                    "format": "json",
+                    "sheet_name": self.competition_name,
+                    "object_id": attachment.key,
+                    "permissions_column": attachment.column_name,
+                    "attachment_name": attachment.file,
+                },
+                {"attachment": reader},
+            )
+        return (attachment, reader.sha256(), reader.size)
 
     def upload_toc(self, toc):
         """Upload a Toc represented by TOC, which will also create the page
         for the Toc if it doesn't already exist on the wiki"""
-        self.site.raw_call(
-            "api",
-            {
-                "action": "torquedataconnectuploadtoc",
-                "format": "json",
-                "sheet_name": self.competition_name,
-                "toc_name": toc.name,
-            },
-            {"template": toc.template_file(), "json": json.dumps(toc.grouped_data())},
-        )
-
-        p = self.site.pages[toc.name]
-        if not p.exists:
-            p.save(
-                """<!-- This page is generated by the ETL pipelines in the https://github.com/OpenTechStrategies/torque-sites/. It is rendered based on the template in the Torque Configuration (TorqueConfig:MainConfig), and the '#tdcrender' line below is correct. Normally, this page should not be edited, as any edits you make here will not be stored in the Torque database and thus would be lost the next time the ETL process is run.-->
-{{ #tdcrender:%s/toc/%s.mwiki }}"""
-                % (self.competition_name, toc.name)
+        with self.thread_site() as site:
+            site.raw_call(
+                "api",
+                {
+                    "action": "torquedataconnectuploadtoc",
+                    "format": "json",
+                    "sheet_name": self.competition_name,
+                    "toc_name": toc.name,
+                },
+                {
+                    "template": toc.template_file(),
+                    "json": json.dumps(toc.grouped_data()),
+                },
             )
 
-    def create_pages(self, comp):
+            p = site.pages[toc.name]
+            if not p.exists:
+                p.save(toc_page_body(self.competition_name, toc))
+
+    def create_pages(self, comp, extra_pages=None):
         """Creates all the pages in the Competition COMP according to their
         wiki title, which will only upload if the page doesn't already exist.
 
-        That page will have a single line contaning the #tdcrender call."""
-        for proposal in comp.ordered_proposals():
-            page_title = proposal.cell(
-                competition.MediaWikiTitleAdder.title_column_name
-            )
+        That page will have a single line contaning the #tdcrender call.
 
-            if page_title is None:
-                raise Exception("Competition needs the page title adder run")
+        EXTRA_PAGES, a dict of title to body, are the other pages for the
+        proposals (like their "Evaluations of" pages) that are created the
+        same way, along with the proposal pages.  Which of the pages exist is
+        asked for in batches, and then only the missing ones are saved.
 
-            self.create_page(
-                page_title,
-                """<!-- This page is generated by the ETL pipelines in the https://github.com/OpenTechStrategies/torque-sites/. It is rendered based on the template in the Torque Configuration (TorqueConfig:MainConfig), and the '#tdcrender' line below is correct. Normally, this page should not be edited, as any edits you make here will not be stored in the Torque database and thus would be lost the next time the ETL process is run.-->
-{{ #tdcrender:%s/id/%s.mwiki }}"""
-                % (self.competition_name, proposal.key()),
-            )
+        The pages for proposals that COMP had on the last run, but that
+        aren't among these pages any more, are reported, when that can be
+        told (see reports_orphaned_pages and report_orphaned_pages)."""
+        pages = proposal_pages(comp, self.competition_name, extra_pages)
+        normalized_titles = self.create_missing_pages(pages)
+        if reports_orphaned_pages(comp):
+            self.report_orphaned_pages(normalized_titles, comp.previous_keys)
 
     def create_page(self, page_title, body, create_if_exists=False):
         if not page_title:
             return
 
-        try:
-            p = self.site.pages[page_title]
+        write = (
+            "Saving " + page_title,
+            self.save_page,
+            (page_title, body, create_if_exists),
+        )
+        for description, result in self.run_writes([write]):
+            pass
+
+    def save_page(self, page_title, body, create_if_exists):
+        """Saves the page PAGE_TITLE with BODY, if it doesn't exist or
+        CREATE_IF_EXISTS"""
+        with self.thread_site() as site:
+            p = site.pages[page_title]
             if not p.exists or create_if_exists:
                 p.save(body)
-        except:
-            print(page_title + " failed to save")
+
+    def query_titles(self, titles):
+        """Returns a dict of each of TITLES to the title the wiki normalizes
+        it to and whether a page with it exists, as a tuple, asking about
+        them in batches.  Titles that the wiki can't have are left out."""
+        batch_size = TITLES_PER_QUERY
+        if "apihighlimits" in self.site.rights:
+            batch_size = 500
+
+        queried = {}
+        for start in range(0, len(titles), batch_size):
+            batch = titles[start : start + batch_size]
+            result = self.site.api("query", titles="|".join(batch))
+            queried.update(parse_titles_query(batch, result))
+        return queried
+
+    def create_missing_pages(self, pages):
+        """Saves the PAGES, a dict of title to body, that don't exist on the
+        wiki, and returns the set of all their titles as the wiki normalizes
+        them"""
+        titles = [title for title in pages if title]
+        queried = self.query_titles(titles)
+
+        for title in titles:
+            if title not in queried:
+                self.failures.append(("Saving " + title, "not a valid title"))
+
+        created = 0
+        for description, was_created in self.run_writes(
+            ("Saving " + title, self.create_missing_page, (title, pages[title]))
+            for title in titles
+            if title in queried and not queried[title][1]
+        ):
+            if was_created:
+                created += 1
+
+        print(
+            "%d pages created, %d already existed" % (created, len(queried) - created)
+        )
+        return {normalized_title for (normalized_title, exists) in queried.values()}
+
+    def create_missing_page(self, page_title, body):
+        """Creates the page PAGE_TITLE with BODY, and returns whether it did,
+        which it doesn't if the page was made since it was asked about"""
+        with self.thread_site() as site:
+            try:
+                site.post(
+                    "edit",
+                    title=page_title,
+                    text=body,
+                    token=site.get_token("csrf"),
+                    createonly="1",
+                    bot="1",
+                )
+            except mwclient.errors.APIError as e:
+                if e.code != "articleexists":
+                    raise
+                return False
+            return True
+
+    def report_orphaned_pages(self, titles, previous_keys):
+        """Prints the pages on the wiki that were for one of PREVIOUS_KEYS,
+        with a title ending in "(<key>)", but aren't in TITLES, usually
+        because the proposal was taken out of the competition or its title
+        changed.  They're found from a listing of all the pages, and left
+        alone."""
+        print_orphaned_pages(
+            [
+                page.name
+                for page in self.site.allpages()
+                if is_orphaned(page.name, titles, previous_keys)
+            ]
+        )
+
+
+def generated_page_body(render_path):
+    """Returns the body of a page that's rendered by TDC from RENDER_PATH,
+    like <sheet name>/id/<key>.mwiki"""
+    return (
+        """<!-- This page is generated by the ETL pipelines in the https://github.com/OpenTechStrategies/torque-sites/. It is rendered based on the template in the Torque Configuration (TorqueConfig:MainConfig), and the '#tdcrender' line below is correct. Normally, this page should not be edited, as any edits you make here will not be stored in the Torque database and thus would be lost the next time the ETL process is run.-->
+{{ #tdcrender:%s }}"""
+        % render_path
+    )
+
+
+def toc_page_body(competition_name, toc):
+    """Returns the body of the page for TOC in COMPETITION_NAME"""
+    return generated_page_body("%s/toc/%s.mwiki" % (competition_name, toc.name))
+
+
+def proposal_pages(comp, competition_name, extra_pages=None):
+    """Returns a dict of title to body of the pages for the proposals in
+    the Competition COMP, uploaded as COMPETITION_NAME, along with
+    EXTRA_PAGES (see WikiSession.create_pages)"""
+    pages = {}
+    for proposal in comp.ordered_proposals():
+        page_title = proposal.cell(competition.MediaWikiTitleAdder.title_column_name)
+
+        if page_title is None:
+            raise Exception("Competition needs the page title adder run")
+
+        pages[page_title] = generated_page_body(
+            "%s/id/%s.mwiki" % (competition_name, proposal.key())
+        )
+    if extra_pages is not None:
+        pages.update(extra_pages)
+    return pages
+
+
+def parse_titles_query(titles, result):
+    """Returns what WikiSession.query_titles does for TITLES, from RESULT,
+    the response to a query for them"""
+    result = result["query"]
+    normalized = {
+        normalization["from"]: normalization["to"]
+        for normalization in result.get("normalized", [])
+    }
+    pages = {page["title"]: page for page in result["pages"].values()}
+
+    queried = {}
+    for title in titles:
+        page = pages.get(normalized.get(title, title))
+        if page is None or "invalid" in page:
+            continue
+        queried[title] = (page["title"], "missing" not in page)
+    return queried
+
+
+def reports_orphaned_pages(comp):
+    """Returns whether the orphaned pages of the Competition COMP can be
+    told, which needs the keys it had on the last run, and all of its
+    proposals to be in this run, so it can't be pared or filtered"""
+    return comp.previous_keys is not None and comp.pare is None and not comp.filtered
+
+
+def is_orphaned(page_title, titles, previous_keys):
+    """Returns whether the page PAGE_TITLE was for a proposal with one of
+    PREVIOUS_KEYS, by ending in "(<key>)", but isn't in TITLES, so that
+    pages for other sheets on the same wiki, or made by hand, are left out"""
+    if page_title in titles:
+        return False
+
+    match = re.search(" \\(([^()]+)\\)$", page_title)
+    return match is not None and match.group(1) in previous_keys
+
+
+def print_orphaned_pages(orphaned_titles):
+    for title in orphaned_titles:
+        print("Orphaned page: " + title)
+    print("%d orphaned pages" % len(orphaned_titles))
@@ -11,4 +11,5 @@ setup(
     url="https://github.com/OpenTechStrategies/torque-sites",
     packages=["etl"],
     install_requires=["mwclient", "bs4", "unidecode"],
+    extras_require={"async": ["aiohttp"]},
 )